@@ -0,0 +1,137 @@
+"""Streaming statistics over numeric columns, by calendar window.
+
+Stats keeps count, sum, min, max, and mean and variance (Welford's
+method) of a column without keeping the values.  An Aggregator keeps
+Stats per column for each period of the finest window asked for (day,
+month, quarter, year or all), and works out the coarser windows at the
+end by merging those, so asking for every window costs about the same as
+asking for one."""
+
+from collections import OrderedDict
+
+from csv_utilities import ZERO
+
+WINDOWS = OrderedDict([
+    ("day", lambda date: date),
+    ("month", lambda date: date.replace(day=1)),
+    ("quarter", lambda date: date.replace(month=date.month - (date.month - 1) % 3,
+                                          day=1)),
+    ("year", lambda date: date.replace(month=1, day=1)),
+    ("all", lambda date: None),
+])
+
+LABELS = {
+    "day": lambda start: start.isoformat(),
+    "month": lambda start: start.strftime("%Y-%m"),
+    "quarter": lambda start: "%i-Q%i" % (start.year, (start.month + 2) // 3),
+    "year": lambda start: str(start.year),
+    "all": lambda start: "all",
+}
+
+class Stats:
+    __slots__ = ("count", "total", "mean", "m2", "minimum", "maximum")
+
+    def __init__(self):
+        self.count = 0
+        self.total = ZERO
+        self.mean = ZERO
+        self.m2 = ZERO
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+
+    def merge(self, other):
+        """Adds the values of other, without having them (Chan et al.)."""
+        if not other.count:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.total += other.total
+        if self.minimum is None or other.minimum < self.minimum:
+            self.minimum = other.minimum
+        if self.maximum is None or other.maximum > self.maximum:
+            self.maximum = other.maximum
+
+    def average(self):
+        return self.total / self.count if self.count else None
+
+    def variance(self):
+        """Returns the sample variance, or None with less than two values."""
+        return self.m2 / (self.count - 1) if self.count > 1 else None
+
+class Aggregator:
+    """Stats are made with stats, such as fixed_point.Stats in place of
+Stats."""
+
+    def __init__(self, columns, windows=("all",), stats=Stats):
+        for window in windows:
+            if window not in WINDOWS:
+                raise ValueError("Unknown window", window, list(WINDOWS))
+        order = list(WINDOWS)
+        self.columns = columns
+        self.stats = stats
+        self.windows = sorted(set(windows), key=order.index)
+        self.key = WINDOWS[self.windows[0]]
+        self.groups = {}
+        self.first = self.last = None
+
+    def add(self, date, values):
+        """Adds a row of column values for a date, in any date order."""
+        key = self.key(date)
+        stats = self.groups.get(key)
+        if stats is None:
+            stats = self.groups[key] = [self.stats() for index in range(self.columns)]
+        for column, value in zip(stats, values):
+            column.add(value)
+        if self.first is None or date < self.first:
+            self.first = date
+        if self.last is None or date > self.last:
+            self.last = date
+
+    def results(self):
+        """Returns an OrderedDict of window -> OrderedDict of the start date
+of each period (None for all) -> list of Stats, one per column."""
+        results = OrderedDict()
+        finest = OrderedDict((key, self.groups[key]) for key in
+                             sorted(self.groups, key=lambda key: (key is not None, key)))
+        for window in self.windows:
+            if window == self.windows[0]:
+                results[window] = finest
+                continue
+            key_function = WINDOWS[window]
+            groups = OrderedDict()
+            for key, stats in finest.items():
+                key = key_function(key) if key is not None else None
+                merged = groups.get(key)
+                if merged is None:
+                    merged = groups[key] = [self.stats() for index in range(self.columns)]
+                for column, other in zip(merged, stats):
+                    column.merge(other)
+            results[window] = groups
+        return results
+
+    def rows(self, names):
+        """Yields a header and a row per window, period and column, with
+the columns named by names."""
+        yield ["window", "period", "column", "count", "sum", "mean", "min",
+               "max", "variance"]
+        for window, groups in self.results().items():
+            label = LABELS[window]
+            for start, stats in groups.items():
+                for name, column in zip(names, stats):
+                    yield [window, label(start), name, column.count,
+                           column.total, column.average(), column.minimum,
+                           column.maximum, column.variance()]
@@ -0,0 +1,247 @@
+#!/usr/bin/python3
+
+"""Runs many process_chain.py chains in one process, from a manifest.
+
+./batch.py <manifest> [--workers N] [--max-gap N] [--cache-dir DIR] [--mmap]
+
+Each line of the manifest is a chain as given to process_chain.py,
+optionally followed by > and a file to write the converted lines to,
+such as
+
+wallet1.csv 0,3 :: ETC-USD.csv 3,2 :: testdata/USD-NOK.csv -1 -2 > wallet1-nok.csv
+
+Blank lines and lines starting with # are skipped, and words can be
+quoted as in a shell.  Chains without an output file are written to
+standard output, one after the other, in manifest order.
+
+Every transaction file (by path and date index) and every rate file (by
+path and columns) is parsed once, in a pool of processes, however many
+chains use it.  The chains are then converted with the shared tables, in
+up to --workers processes (the number of CPUs by default), which are
+forked so they don't have to be sent the tables."""
+
+import io, multiprocessing, os, shlex, sys
+
+from concurrent.futures import ProcessPoolExecutor
+
+import cache, profiling
+from csv_utilities import guess_number_parser, parse_float, write_csv_lines, \
+     NUMBER_SAMPLE_SIZE
+from process_chain import convert_table, init_worker, load_rate_file, parse_stage
+from rates import MAX_GAP
+from table import get_sorted_table
+from utilities import DEBUG_PRINT, get_flag, get_option
+
+# What fails a chain, without stopping the others
+ERRORS = (ValueError, IndexError, KeyError, OSError, ArithmeticError)
+
+# Set before the chains are converted, and inherited by forked workers
+TABLES = {}
+RATE_TABLES = {}
+
+class Chain:
+    def __init__(self, number, filename, date_index, value_index, stages, output=None):
+        self.number = number
+        self.filename = filename
+        self.date_index = date_index
+        self.value_index = value_index
+        self.stages = stages
+        self.output = output
+
+    def table_key(self):
+        return os.path.abspath(self.filename), self.date_index
+
+    def rate_keys(self):
+        return [(os.path.abspath(filename), low, high, date_index)
+                for filename, low, high, date_index in self.stages]
+
+def parse_manifest_line(number, line):
+    """Returns the Chain on a line of a manifest, or None for a blank
+line or a comment.  Raises ValueError, with number as its last
+argument, if the line isn't a chain."""
+    try:
+        words = shlex.split(line, comments=True)
+    except ValueError as error:
+        raise ValueError(*error.args, number)
+    if not words:
+        return None
+    output = None
+    if ">" in words:
+        index = words.index(">")
+        if index != len(words) - 2:
+            raise ValueError("> must be followed by one output file", number)
+        output = words[-1]
+        words = words[:index]
+    calls = [[]]
+    for word in words:
+        if word == "::":
+            calls.append([])
+        else:
+            calls[-1].append(word)
+    initial_call = calls.pop(0)
+    if len(initial_call) != 2:
+        raise ValueError("A chain starts with <CSV file> <date_index,value_index>",
+                         number)
+    for call in calls:
+        if len(call) not in (2, 3):
+            raise ValueError("A stage is <CSV file> <low,high> [date_index]", number)
+    try:
+        date_index, value_index = map(int, initial_call[1].split(","))
+        stages = [parse_stage(call) for call in calls]
+    except ValueError:
+        raise ValueError("Indexes must be integers, such as 0,3", number)
+    return Chain(number, initial_call[0], date_index, value_index, stages, output)
+
+def read_manifest(filename):
+    """Returns the chains of a manifest.  Raises ValueError, with the line
+number as its last argument, for a line that isn't a chain, or a chain
+writing to the same file as an earlier one."""
+    chains = []
+    outputs = {}
+    with open(filename, "r") as file:
+        for number, line in enumerate(file, 1):
+            chain = parse_manifest_line(number, line)
+            if chain is None:
+                continue
+            if chain.output:
+                output = os.path.abspath(chain.output)
+                if output in outputs:
+                    raise ValueError("Output file also written by line %i"
+                                     % outputs[output], chain.output, number)
+                outputs[output] = number
+            chains.append(chain)
+    return chains
+
+def load_transactions(filename, date_index):
+    """Calls get_sorted_table in a worker process, returning the table,
+the separator and the profile of loading it, if profiling."""
+    if profiling.PROFILE is not None:
+        profiling.enable()
+    table, separator = get_sorted_table(filename, sort_field=date_index)
+    return table, separator, profiling.PROFILE
+
+def load_all(chains, max_gap=MAX_GAP, mapped=False, workers=None):
+    """Parses each transaction and rate file used by the chains once, into
+TABLES and RATE_TABLES.  A file that can't be parsed gets the error
+instead, which fails the chains using it."""
+    transactions = {}
+    rates = {}
+    for chain in chains:
+        transactions.setdefault(chain.table_key(), (chain.filename, chain.date_index))
+        for key, stage in zip(chain.rate_keys(), chain.stages):
+            rates.setdefault(key, stage)
+    DEBUG_PRINT("Loading", len(transactions), "transaction files and",
+                len(rates), "rate tables for", len(chains), "chains")
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=init_worker,
+                             initargs=(cache.CACHE_DIR,
+                                       profiling.PROFILE is not None)) as executor:
+        table_futures = {key: executor.submit(load_transactions, *arguments)
+                         for key, arguments in transactions.items()}
+        rate_futures = {key: executor.submit(load_rate_file, filename, low, high,
+                                             date_index=date_index,
+                                             max_gap=max_gap, mapped=mapped)
+                        for key, (filename, low, high, date_index) in rates.items()}
+        for key, future in table_futures.items():
+            try:
+                table, separator, profile = future.result()
+            except ERRORS as error:
+                TABLES[key] = error
+                continue
+            TABLES[key] = table, separator
+            if profile is not None:
+                profiling.PROFILE.merge(profile)
+        for key, future in rate_futures.items():
+            try:
+                rate_table, profile = future.result()
+            except ERRORS as error:
+                RATE_TABLES[key] = error
+                continue
+            RATE_TABLES[key] = rate_table
+            if profile is not None:
+                profiling.PROFILE.merge(profile)
+
+def loaded(entry):
+    """Returns an entry of TABLES or RATE_TABLES, raising the error if the
+file couldn't be parsed."""
+    if isinstance(entry, Exception):
+        raise entry
+    return entry
+
+def run_chain(chain):
+    """Converts a chain with the shared tables, and writes it to its output
+file, or returns it as text if it has none."""
+    shared, separator = loaded(TABLES[chain.table_key()])
+    table = shared.copy()
+    parse = parse_float
+    if len(table):
+        parse = guess_number_parser(table.column(chain.value_index, NUMBER_SAMPLE_SIZE))
+    convert_table(table, chain.value_index,
+                  [loaded(RATE_TABLES[key]) for key in chain.rate_keys()],
+                  parse=parse)
+    if chain.output:
+        with open(chain.output, "w") as file:
+            write_csv_lines(table, separator, file=file)
+        return None
+    text = io.StringIO()
+    write_csv_lines(table, separator, file=text)
+    return text.getvalue()
+
+def run_chains(chains, workers=None):
+    """Generator yielding each chain with its text (None if written to a
+file) or the error that stopped it, in order.  Chains are run in forked
+processes where possible, otherwise in this one."""
+    if workers == 1 or "fork" not in multiprocessing.get_all_start_methods():
+        for chain in chains:
+            try:
+                yield chain, run_chain(chain)
+            except ERRORS as error:
+                yield chain, error
+        return
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        futures = [executor.submit(run_chain, chain) for chain in chains]
+        for chain, future in zip(chains, futures):
+            try:
+                yield chain, future.result()
+            except ERRORS as error:
+                yield chain, error
+
+def runner():
+    profiling.enable_from_arguments()
+    workers = get_option("--workers", type_=int)
+    max_gap = get_option("--max-gap", MAX_GAP, type_=int)
+    cache.CACHE_DIR = get_option("--cache-dir", cache.CACHE_DIR)
+    mapped = get_flag("--mmap")
+    try:
+        manifest = sys.argv[1]
+    except IndexError:
+        print("Error, use:", sys.argv[0], "<manifest> [--workers N] [--max-gap N]",
+              "[--cache-dir DIR] [--mmap]")
+        print()
+        print("Each line of the manifest is a chain as for process_chain.py,",
+              "optionally followed by > FILE")
+        sys.exit(1)
+    try:
+        chains = read_manifest(manifest)
+    except ValueError as error:
+        print("Error in manifest", manifest, "line %i:" % error.args[-1],
+              *error.args[:-1])
+        sys.exit(1)
+    with profiling.stage("loading"):
+        load_all(chains, max_gap=max_gap, mapped=mapped, workers=workers)
+    failed = 0
+    with profiling.stage("chains"):
+        for chain, result in run_chains(chains, workers):
+            if isinstance(result, Exception):
+                message = [result] if isinstance(result, OSError) else result.args
+                print("Error in chain on line %i:" % chain.number, *message,
+                      file=sys.stderr)
+                failed += 1
+            elif result is not None:
+                sys.stdout.write(result)
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    runner()
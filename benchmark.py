@@ -0,0 +1,212 @@
+#!/usr/bin/python3
+
+"""Benchmarks the parsing and conversion pipeline on generated CSV files.
+
+./benchmark.py [--rows 10000,100000] [--seed 1] [--output benchmark.json]
+               [--directory DIR]
+./benchmark.py --compare old.json new.json
+
+Transaction, rate and MDA-style (Norges Bank) files are generated with a
+seeded random generator, for each number of rows and each variant of
+separator, quoting, date layout and decimal mark.  The files are read,
+converted and rendered by the same functions as the scripts, and each
+stage they time with profiling.stage (detection, splitting, date parsing,
+sorting, conversion, rendering and so on) is written to a JSON file,
+which can be compared with that of another commit with --compare."""
+
+import json, os, platform, random, subprocess, sys, tempfile, time
+
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import profiling
+from csv_utilities import get_sorted_lines, guess_number_format, \
+     make_number_parser, print_csv_lines, NUMBER_SAMPLE_SIZE
+from process_chain import convert_table
+from rates import RateTable
+from table import get_sorted_table
+from utilities import get_option
+
+START = datetime(2010, 1, 1)
+END = datetime(2024, 12, 31)
+
+# name: (separator, quoted, date layout, decimal mark)
+VARIANTS = {
+    "comma-quoted-iso": (",", True, "%Y-%m-%d %H:%M:%S", "."),
+    "comma-plain-us": (",", False, "%m/%d/%Y %H:%M", "."),
+    "comma-quoted-t": (",", True, "%Y-%m-%dT%H:%M:%S", "."),
+    "semicolon-plain-dotted": (";", False, "%d.%m.%Y %H:%M:%S", ","),
+    "semicolon-quoted-iso": (";", True, "%Y-%m-%d, %H:%M:%S", ","),
+}
+
+MDA_HEADER = ("FREQ;Frekvens;BASE_CUR;Basisvaluta;QUOTE_CUR;Kvoteringsvaluta;"
+              "TENOR;Løpetid;DECIMALS;CALCULATED;UNIT_MULT;Multiplikator;"
+              "COLLECTION;Innsamlingstidspunkt;TIME_PERIOD;OBS_VALUE")
+MDA_PREFIX = ("B;Virkedag;USD;Amerikanske dollar;NOK;Norske kroner;SP;Spot;4;"
+              "false;0;Enheter;C;ECB concertation tidspunkt 14:15 CET")
+
+def format_number(value, decimal):
+    text = "%.4f" % value
+    if decimal == ",":
+        text = text.replace(".", ",")
+    return text
+
+def write_row(file, columns, separator, quoted):
+    if quoted:
+        file.write('"' + ('"' + separator + '"').join(columns) + '"\n')
+    else:
+        file.write(separator.join(columns) + "\n")
+
+def generate_transactions(filename, rows, variant, seed):
+    """Writes a transaction file: date, amount, asset and a note, in
+random date order."""
+    separator, quoted, layout, decimal = VARIANTS[variant]
+    generator = random.Random(seed)
+    span = int((END - START).total_seconds())
+    assets = ("BTC", "ETH", "ETC", "XMR")
+    with open(filename, "w") as file:
+        write_row(file, ("Date", "Amount", "Asset", "Note"), separator, quoted)
+        for index in range(rows):
+            date = START + timedelta(seconds=generator.randrange(span))
+            amount = generator.uniform(-5, 5)
+            write_row(file, (date.strftime(layout),
+                             format_number(amount, decimal),
+                             generator.choice(assets), "note %i" % index),
+                      separator, quoted)
+
+def generate_rates(filename, rows, variant, seed):
+    """Writes a rate file: date, low and high, with rows spread evenly
+over the benchmark period (so several rows can share a date)."""
+    separator, quoted, layout, decimal = VARIANTS[variant]
+    layout = layout.split(" ")[0].split("T")[0].rstrip(",")
+    generator = random.Random(seed)
+    step = (END - START).total_seconds() / rows
+    with open(filename, "w") as file:
+        write_row(file, ("Date", "Low", "High"), separator, quoted)
+        for index in range(rows):
+            date = START + timedelta(seconds=index * step)
+            low = generator.uniform(5, 10)
+            write_row(file, (date.strftime(layout),
+                             format_number(low, decimal),
+                             format_number(low + generator.uniform(0, 1), decimal)),
+                      separator, quoted)
+
+def generate_mda(filename, rows, variant, seed):
+    """Writes a Norges Bank style file, always ; separated with decimal
+commas like the real ones."""
+    generator = random.Random(seed)
+    step = (END - START).total_seconds() / rows
+    with open(filename, "w") as file:
+        file.write(MDA_HEADER + "\n")
+        for index in range(rows):
+            date = START + timedelta(seconds=index * step)
+            file.write("%s;%s;%s\n" % (MDA_PREFIX, date.strftime("%Y-%m-%d"),
+                                       format_number(generator.uniform(5, 12), ",")))
+
+def daily_rates(seed):
+    """Returns a RateTable with a rate for every day of the benchmark period."""
+    generator = random.Random(seed)
+    table = RateTable()
+    date = START.date()
+    while date <= END.date():
+        table.append(date, Decimal(format_number(generator.uniform(5, 12), ".")))
+        date += timedelta(days=1)
+    return table
+
+def benchmark_file(filename, date_index, value_index, rates=None):
+    """Reads a file as the scripts do, with get_sorted_lines, or for
+transactions to convert, with get_sorted_table and convert_table as in
+process_chain.py, and renders it, returning the seconds of each stage
+the profiler saw."""
+    profile = profiling.enable()
+    try:
+        if rates is None:
+            lines, separator = get_sorted_lines(filename, sort_field=date_index,
+                                                keep_datetime_objects=True)
+            lines = list(lines)
+        else:
+            table, separator = get_sorted_table(filename, sort_field=date_index)
+            number_format = guess_number_format(
+                table.column(value_index, NUMBER_SAMPLE_SIZE))
+            lines = convert_table(table, value_index, [rates],
+                                  parse=make_number_parser(*number_format))
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            print_csv_lines(lines, separator)
+    finally:
+        profiling.PROFILE = None
+    return {stage: timing["seconds"] for stage, timing in profile.stages.items()}
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+                              ).stdout.strip()
+    except OSError:
+        return None
+
+def run(row_counts, seed, directory):
+    rates = daily_rates(seed)
+    results = []
+    datasets = (("transactions", generate_transactions, 0, 1, rates),
+                ("rates", generate_rates, 0, 1, None),
+                ("mda", generate_mda, -2, -1, None))
+    for rows in row_counts:
+        for dataset, generate, date_index, value_index, table in datasets:
+            variants = VARIANTS if dataset != "mda" else ("semicolon-plain-dotted",)
+            for variant in variants:
+                filename = os.path.join(directory, "%s-%s-%i.csv" %
+                                        (dataset, variant, rows))
+                generate(filename, rows, variant, seed)
+                stages = benchmark_file(filename, date_index, value_index,
+                                        rates=table)
+                os.remove(filename)
+                results.append({"dataset": dataset, "variant": variant,
+                                "rows": rows, "stages": stages})
+                print("%-12s %-24s %9i %s" % (dataset, variant, rows, " ".join(
+                    "%s=%.3f" % (stage, seconds)
+                    for stage, seconds in stages.items())))
+    return results
+
+def compare(old_filename, new_filename):
+    """Prints the ratio new/old of each stage timing of two result files."""
+    with open(old_filename) as file:
+        old = json.load(file)
+    with open(new_filename) as file:
+        new = json.load(file)
+    old_results = {(result["dataset"], result["variant"], result["rows"]): result
+                   for result in old["results"]}
+    print(old.get("revision"), "->", new.get("revision"))
+    for result in new["results"]:
+        key = (result["dataset"], result["variant"], result["rows"])
+        if key not in old_results:
+            continue
+        ratios = []
+        for stage, seconds in result["stages"].items():
+            old_seconds = old_results[key]["stages"].get(stage)
+            if old_seconds:
+                ratios.append("%s=%.2fx" % (stage, seconds / old_seconds))
+        print("%-12s %-24s %9i %s" % (key + (" ".join(ratios),)))
+
+def runner():
+    compare_files = get_option("--compare")
+    if compare_files:
+        if len(sys.argv) != 2:
+            print("Error, use:", sys.argv[0], "--compare old.json new.json")
+            sys.exit(1)
+        compare(compare_files, sys.argv[1])
+        return
+    row_counts = get_option("--rows", [10000],
+                            type_=lambda value: [int(rows) for rows in value.split(",")])
+    seed = get_option("--seed", 1, type_=int)
+    output = get_option("--output", "benchmark.json")
+    directory = get_option("--directory")
+    with tempfile.TemporaryDirectory(dir=directory) as directory:
+        results = run(row_counts, seed, directory)
+    with open(output, "w") as file:
+        json.dump({"revision": git_revision(), "python": platform.python_version(),
+                   "seed": seed, "results": results}, file, indent=1)
+    print("Wrote", output)
+
+if __name__ == "__main__":
+    runner()
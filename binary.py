@@ -0,0 +1,145 @@
+"""A compact binary file of typed columns, for rows that have been parsed
+already, such as the output of process_chain --binary FILE.
+
+The file starts with MAGIC and a JSON header with the separator and the
+type of each column: datetime, decimal or text.  Rows follow in blocks of
+up to BLOCK_SIZE, each a row count and then every column of the block:
+datetimes as an array of microseconds since 0001-01-01, decimals as
+their ASCII strings and text as UTF-8, both separated by NUL.  A row
+count of 0 ends the file.
+
+csv_utilities.get_sorted_lines and read_dated_rows read these files
+instead of CSV when they start with MAGIC, so mda.py and summarize.py can
+load them without detecting formats or parsing text."""
+
+import json, os, struct
+
+from array import array
+from datetime import datetime
+from decimal import Decimal
+from itertools import islice
+
+from utilities import datetime_to_key, key_to_datetime
+
+MAGIC = b"TAXMAN-COLUMNS-1\n"
+BLOCK_SIZE = 1 << 16
+COUNT = struct.Struct("<I")
+LENGTH = struct.Struct("<Q")
+
+def is_binary(filename):
+    """Returns true if a file starts with MAGIC.  Only regular files are
+looked at, as reading the start of a pipe would lose it."""
+    if not os.path.isfile(filename):
+        return False
+    with open(filename, "rb") as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+def class_type(class_):
+    if issubclass(class_, datetime):
+        return "datetime"
+    if issubclass(class_, Decimal):
+        return "decimal"
+    return "text"
+
+def column_type(value):
+    return class_type(type(value))
+
+def encode(values, type_):
+    if type_ == "datetime":
+        return array("q", map(datetime_to_key, values)).tobytes()
+    if type_ == "decimal":
+        return "\0".join(map(str, values)).encode("ascii")
+    return "\0".join(map(str, values)).encode("utf-8")
+
+def decode(data, type_):
+    if type_ == "datetime":
+        keys = array("q")
+        keys.frombytes(data)
+        return list(map(key_to_datetime, keys))
+    if type_ == "decimal":
+        return list(map(Decimal, data.decode("ascii").split("\0")))
+    return data.decode("utf-8").split("\0")
+
+def check_block(block, types, first=0):
+    """Raises ValueError if a row of a block isn't as wide as types, or has
+a value that isn't of its column's type.  first is the number of the
+first row of the block, for the error."""
+    width = len(types)
+    for number, row in enumerate(block, first):
+        if len(row) != width:
+            raise ValueError("Row has %i columns, not %i" % (len(row), width),
+                             number)
+    for index, (type_, values) in enumerate(zip(types, zip(*block))):
+        for class_ in set(map(type, values)):
+            if class_type(class_) != type_:
+                number = next(number for number, value in enumerate(values, first)
+                              if type(value) is class_)
+                raise ValueError("Column %i holds %s, not %s"
+                                 % (index, class_type(class_), type_), number)
+
+def write(filename, rows, separator=","):
+    """Writes rows, with the column types of the first row, to a file.
+Raises ValueError if a row has another width, or a value another type."""
+    rows = iter(rows)
+    block = list(islice(rows, BLOCK_SIZE))
+    types = [column_type(value) for value in block[0]] if block else []
+    first = 0
+    with open(filename, "wb") as file:
+        file.write(MAGIC)
+        header = json.dumps({"separator": separator, "types": types}).encode("utf-8")
+        file.write(COUNT.pack(len(header)))
+        file.write(header)
+        while block:
+            try:
+                check_block(block, types, first)
+            except ValueError:
+                # Not left half written
+                file.close()
+                os.remove(filename)
+                raise
+            first += len(block)
+            file.write(COUNT.pack(len(block)))
+            for type_, values in zip(types, zip(*block)):
+                data = encode(values, type_)
+                file.write(LENGTH.pack(len(data)))
+                file.write(data)
+            block = list(islice(rows, BLOCK_SIZE))
+        file.write(COUNT.pack(0))
+
+def read_header(file):
+    if file.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a binary column file", file.name)
+    length, = COUNT.unpack(file.read(COUNT.size))
+    return json.loads(file.read(length).decode("utf-8"))
+
+def read_rows(filename, columns=None):
+    """Generator yielding the rows of a file as lists.  If columns is a
+list of column indexes, rows only hold those columns, in that order, and
+the other columns aren't decoded."""
+    with open(filename, "rb") as file:
+        types = read_header(file)["types"]
+        if not types:
+            return
+        if columns is None:
+            columns = range(len(types))
+        wanted = {index % len(types) for index in columns}
+        order = [index % len(types) for index in columns]
+        while True:
+            count, = COUNT.unpack(file.read(COUNT.size))
+            if not count:
+                return
+            decoded = {}
+            for index, type_ in enumerate(types):
+                length, = LENGTH.unpack(file.read(LENGTH.size))
+                if index in wanted:
+                    decoded[index] = decode(file.read(length), type_)
+                else:
+                    file.seek(length, 1)
+            for row in zip(*[decoded[index] for index in order]):
+                yield list(row)
+
+def read(filename, columns=None):
+    """Returns the rows of a file as a list, and the separator."""
+    with open(filename, "rb") as file:
+        separator = read_header(file)["separator"]
+    return list(read_rows(filename, columns)), separator
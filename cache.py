@@ -0,0 +1,119 @@
+"""On-disk cache for parsed files, such as the rate tables returned by
+rates.parse_rate_file.
+
+Entries are pickled to CACHE_DIR, one file per source file and parse
+specification.  Each entry records the path, size and modification time
+of the source file, and is thrown away when the source file has changed.
+At most CACHE_SIZE entries are kept, the least recently used ones are
+removed first.  Caching is off unless CACHE_DIR is set, from the
+TAXMAN_CACHE_DIR environment variable or --cache-dir."""
+
+import hashlib, os, pickle, tempfile
+
+import profiling
+from utilities import DEBUG_PRINT, store_location, STORE_PREFIX
+
+CACHE_DIR = os.environ.get("TAXMAN_CACHE_DIR")
+CACHE_SIZE = int(os.environ.get("TAXMAN_CACHE_SIZE", 64))
+SUFFIX = ".cache"
+
+def set_cache_dir(directory):
+    """Sets CACHE_DIR, for example in worker processes."""
+    global CACHE_DIR
+    CACHE_DIR = directory
+
+def absolute_name(filename):
+    """Returns the absolute path of a file, or for a source in a store, its
+location with the absolute path of the database."""
+    location = store_location(filename)
+    if location is not None:
+        return STORE_PREFIX + os.path.abspath(location[0]) + "#" + location[1]
+    return os.path.abspath(filename)
+
+def file_identity(filename):
+    """Returns what identifies the current contents of a file.  For a
+source in a store, that is the database file."""
+    location = store_location(filename)
+    stat = os.stat(location[0] if location is not None else filename)
+    return absolute_name(filename), stat.st_size, stat.st_mtime_ns
+
+def entry_path(filename, spec):
+    """Returns the path of the cache entry for a file and parse specification."""
+    key = repr((absolute_name(filename), spec)).encode("utf-8")
+    return os.path.join(CACHE_DIR, hashlib.sha256(key).hexdigest() + SUFFIX)
+
+def load(filename, spec):
+    """Returns the cached value for a file parsed with spec, or None."""
+    if not CACHE_DIR:
+        return None
+    path = entry_path(filename, spec)
+    try:
+        with open(path, "rb") as file:
+            identity, value = pickle.load(file)
+    except FileNotFoundError:
+        profiling.count("cache misses")
+        return None
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+        DEBUG_PRINT("Unreadable cache entry", path)
+        profiling.count("cache misses")
+        remove(path)
+        return None
+    if identity != file_identity(filename):
+        DEBUG_PRINT("Stale cache entry", path)
+        profiling.count("cache misses")
+        profiling.count("stale cache entries")
+        remove(path)
+        return None
+    os.utime(path)
+    DEBUG_PRINT("Cache hit", filename, spec)
+    profiling.count("cache hits")
+    return value
+
+def store(filename, spec, value, identity):
+    """Stores the value for a file parsed with spec.  identity is the
+file_identity of the file taken before it was parsed, so a value parsed
+from contents that have changed since is thrown away on the next load."""
+    if not CACHE_DIR:
+        return
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    descriptor, temporary = tempfile.mkstemp(dir=CACHE_DIR)
+    with os.fdopen(descriptor, "wb") as file:
+        pickle.dump((identity, value), file, pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, entry_path(filename, spec))
+    prune()
+
+def prune(size=None):
+    """Removes the least recently used entries beyond size entries."""
+    if size is None:
+        size = CACHE_SIZE
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        if name.endswith(SUFFIX):
+            path = os.path.join(CACHE_DIR, name)
+            try:
+                entries.append((os.stat(path).st_mtime_ns, path))
+            except FileNotFoundError:
+                pass
+    entries.sort(reverse=True)
+    for mtime, path in entries[size:]:
+        remove(path)
+
+def remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def cached(filename, spec, parse, encode=None, decode=None):
+    """Returns the cached value for a file parsed with spec, calling parse
+and caching its result if there is none.
+
+encode and decode convert the value to and from what is pickled, for
+values that shouldn't be pickled as they are."""
+    state = load(filename, spec)
+    if state is not None:
+        return decode(state) if decode else state
+    identity = file_identity(filename) if CACHE_DIR else None
+    value = parse()
+    store(filename, spec, encode(value) if encode else value, identity)
+    return value
@@ -0,0 +1,77 @@
+"""Checkpoints for incremental runs over files that are only appended to,
+such as exchange exports that grow every night.
+
+A checkpoint records how far into a file a run got, fingerprints of the
+file up to there, the format of the file and whatever state the script
+needs to carry on, such as running totals or the converted rows so far.
+The next run only parses the rows appended since.  If the file was
+rewritten instead of appended to, or the script was run with different
+arguments, the checkpoint isn't used and the script does a full run."""
+
+import hashlib, os, pickle, tempfile
+
+from csv_utilities import parse_byte_range
+from utilities import DEBUG_PRINT
+
+FINGERPRINT_SIZE = 1 << 16
+
+def fingerprint(filename, offset):
+    """Returns hashes of the start of a file, and of the bytes just before
+offset."""
+    with open(filename, "rb") as file:
+        head = hashlib.sha256(file.read(min(offset, FINGERPRINT_SIZE))).hexdigest()
+        file.seek(max(offset - FINGERPRINT_SIZE, 0))
+        tail = hashlib.sha256(file.read(min(offset, FINGERPRINT_SIZE))).hexdigest()
+    return head, tail
+
+def load(checkpoint_filename, filename, arguments):
+    """Returns the checkpoint for a file and the arguments of a run, or None
+if there is none that can be carried on from."""
+    if not checkpoint_filename or not os.path.exists(checkpoint_filename):
+        return None
+    with open(checkpoint_filename, "rb") as file:
+        checkpoint = pickle.load(file)
+    if checkpoint["filename"] != os.path.abspath(filename) or \
+       checkpoint["arguments"] != arguments:
+        DEBUG_PRINT("Checkpoint is for another file or other arguments")
+        return None
+    offset = checkpoint["offset"]
+    if os.path.getsize(filename) < offset or \
+       fingerprint(filename, offset) != checkpoint["fingerprint"]:
+        DEBUG_PRINT("File was rewritten since the checkpoint")
+        return None
+    return checkpoint
+
+def save(checkpoint_filename, filename, arguments, file_format, state):
+    """Saves a checkpoint at the current end of a file.  file_format is
+what csv_utilities.detect_file_format returned for it."""
+    offset = os.path.getsize(filename)
+    checkpoint = {"filename": os.path.abspath(filename), "arguments": arguments,
+                  "offset": offset, "fingerprint": fingerprint(filename, offset),
+                  "format": file_format, "state": state}
+    directory = os.path.dirname(os.path.abspath(checkpoint_filename))
+    descriptor, temporary = tempfile.mkstemp(dir=directory)
+    with os.fdopen(descriptor, "wb") as file:
+        pickle.dump(checkpoint, file, pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, checkpoint_filename)
+
+def read_appended_rows(filename, checkpoint, field=0, expect_quotes=True):
+    """Returns the rows appended to a file since a checkpoint, split on
+columns and sorted on the datetime in field, or None if the last line
+at the checkpoint has been added to (so the rows can't be appended)."""
+    separator, start, datetime_format, encoding = checkpoint["format"]
+    offset = checkpoint["offset"]
+    end = os.path.getsize(filename)
+    with open(filename, "rb") as file:
+        file.seek(max(offset - 1, 0))
+        previous = file.read(1) if offset else b"\n"
+        following = file.read(2)
+    if previous not in (b"\n", b"\r"):
+        if not following or following[:1] not in (b"\n", b"\r"):
+            return None if following else []
+        # The last line had no newline, which came with the appended rows
+        offset += 2 if following == b"\r\n" else 1
+    if offset >= end:
+        return []
+    return parse_byte_range(filename, offset, end, separator, expect_quotes,
+                            field, datetime_format, encoding)
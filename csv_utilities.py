@@ -1,32 +1,99 @@
 #!/usr/bin/python3
 
 from decimal import Decimal, InvalidOperation
-from datetime import datetime
-import csv, sys
+from bisect import bisect_left
+from datetime import datetime, time, timedelta
+from functools import lru_cache
+from itertools import chain, dropwhile, islice, takewhile
+from operator import itemgetter
+from concurrent.futures import ProcessPoolExecutor
+import csv, heapq, io, os, pickle, re, sys, tempfile
 
 ZERO = Decimal(0)
 SNIFFER = csv.Sniffer()
+READ_CHUNK_SIZE = 1 << 20
+RUN_BATCH_SIZE = 1000
+DATETIME_MEMO_SIZE = 1 << 16
+NUMBER_SAMPLE_SIZE = 100
+DATETIME_SAMPLE_SIZE = 10000
+WRITE_BUFFER_SIZE = 1 << 20
+SEPARATOR_SAMPLE_LINES = 1000
+SEPARATOR_MARGIN = 2
+NUMBER_PATTERN = re.compile("[+-]?([0-9][0-9.,]*|[.,][0-9]+)([eE][+-]?[0-9]+)?")
 
-from utilities import DEBUG_PRINT, WARNING_PRINT
+_TOKEN_PATTERNS = {}
 
-def guess_separator(csv_data_lines, default=","):
-    """Returns a guess at what the column separator is in the CSV data."""
-    semicolon_count_header = csv_data_lines[0].count(";")
-    semicolon_count_data = semicolon_count_header
-    comma_count_header = csv_data_lines[0].count(",")
-    comma_count_data = comma_count_header
-    for line in csv_data_lines[1:]:
-        semicolon_count_data += line.count(";")
-        comma_count_data += line.count(",")
-    if comma_count_data > semicolon_count_data:
+import binary, profiling
+from utilities import DEBUG_PRINT, WARNING_PRINT, get_option, store_location
+
+def choose_separator(comma_count, semicolon_count):
+    """Returns the separator given the number of commas and semicolons."""
+    if comma_count > semicolon_count:
         return ","
-    if comma_count_data < semicolon_count_data:
+    if comma_count < semicolon_count:
         return ";"
     else:
         DEBUG_PRINT("Unable to determine column separator")
         DEBUG_PRINT("Choosing ;")
         return ";"
 
+def separator_settled(comma_count, semicolon_count):
+    """Returns true if one separator is SEPARATOR_MARGIN times as common as
+the other, so that counting more of the file won't change the guess."""
+    most = max(comma_count, semicolon_count)
+    return most > 0 and most >= SEPARATOR_MARGIN * min(comma_count, semicolon_count)
+
+def guess_separator(csv_data_lines, default=","):
+    """Returns a guess at what the column separator is in the CSV data,
+counting SEPARATOR_SAMPLE_LINES lines at a time until it is settled."""
+    semicolon_count = comma_count = 0
+    for index, line in enumerate(csv_data_lines, 1):
+        semicolon_count += line.count(";")
+        comma_count += line.count(",")
+        if not index % SEPARATOR_SAMPLE_LINES and \
+           separator_settled(comma_count, semicolon_count):
+            break
+    return choose_separator(comma_count, semicolon_count)
+
+def guess_separator_file(file, default=",", chunk_size=READ_CHUNK_SIZE):
+    """Returns a guess at what the column separator is in a seekable file,
+counting separators one chunk at a time until it is settled.  The file
+position is restored afterwards."""
+    start = file.tell()
+    semicolon_count = comma_count = 0
+    for chunk in iter(lambda: file.read(chunk_size), ""):
+        semicolon_count += chunk.count(";")
+        comma_count += chunk.count(",")
+        if separator_settled(comma_count, semicolon_count):
+            break
+    file.seek(start)
+    return choose_separator(comma_count, semicolon_count)
+
+def guess_separator_lines(file, default=",", chunk_size=READ_CHUNK_SIZE):
+    """Returns a guess at the column separator of a file, as
+guess_separator_file does, and its lines from the current position.  A
+file that can't be seeked, such as a pipe, isn't read twice: the chunks
+counted are kept, up to the end of a line, and given back first."""
+    if file.seekable():
+        return guess_separator_file(file, default, chunk_size), file
+    semicolon_count = comma_count = 0
+    chunks = []
+    for chunk in iter(lambda: file.read(chunk_size), ""):
+        chunks.append(chunk)
+        semicolon_count += chunk.count(";")
+        comma_count += chunk.count(",")
+        if separator_settled(comma_count, semicolon_count):
+            break
+    head = "".join(chunks)
+    if head and not head.endswith("\n"):
+        head += file.readline()
+    return choose_separator(comma_count, semicolon_count), \
+           chain(io.StringIO(head), file)
+
+def has_header(csv_lines):
+    """Returns true if the first of (up to three) lines looks like a header."""
+    return SNIFFER.has_header("\n".join(csv_lines[0:3]))
+
 def guess_date_format(dates):
     """Guess the date format given a set of dates."""
     year_index = month_index = day_index = None
@@ -80,14 +147,30 @@ def make_date_range(start, end):
     end = datetime.strptime(end, date_format).date()
     return start, end
 
-def filter_on_date_range(start, end, sequence, date_index=0):
+def make_datetime_range(start, end):
+    """Returns the datetimes a date range from start to end (inclusive)
+covers as a (low, high) pair, where low <= datetime < high."""
     start, end = make_date_range(start, end)
-    keep = []
-    for item in sequence:
-        date = item[date_index]
-        if date.date() >= start and date.date() <= end:
-            keep.append(item)
-    return keep
+    return (datetime.combine(start, time()),
+            datetime.combine(end + timedelta(days=1), time()))
+
+def in_datetime_range(rows, field, datetime_range):
+    """Returns the rows with the datetime in field within datetime_range
+(see make_datetime_range)."""
+    low, high = datetime_range
+    return [row for row in rows if low <= row[field] < high]
+
+def filter_on_date_range(start, end, sequence, date_index=0):
+    """Returns the items of a sequence sorted on the datetime in date_index
+that are from start to end.  A list is searched with bisect, other
+iterables are read up to the end of the range."""
+    low, high = make_datetime_range(start, end)
+    key = itemgetter(date_index)
+    if isinstance(sequence, list):
+        return sequence[bisect_left(sequence, low, key=key):
+                        bisect_left(sequence, high, key=key)]
+    return takewhile(lambda item: item[date_index] < high,
+                     dropwhile(lambda item: item[date_index] < low, sequence))
 
 def guess_time_format(times):
     try:
@@ -169,13 +252,89 @@ def parse_time(time_, format=":"):
 def parse_float(value):
     """Parses a float as a Decimal, using either a . or , as the
 denominator."""
-    try:
-        return Decimal(float(value))
-    except ValueError:
+    if "," in value:
         if "." in value:
             return Decimal(value.replace(",", ""))
+        return Decimal(value.replace(",", "."))
+    return Decimal(value)
+
+def guess_number_format(values):
+    """Returns the decimal mark and thousands separator (or None) used in a
+sample of numbers, or None if the values don't all look like numbers.
+
+Where a value has both a . and a , the last one is the decimal mark.
+Otherwise a mark that is repeated within a value separates thousands,
+and a lone , or . is the decimal mark."""
+    decimal = thousands = None
+    match = NUMBER_PATTERN.fullmatch
+    count = 0
+    for value in values:
+        if isinstance(value, Decimal):
+            # Parsed already, as in binary column files
+            count += 1
+            continue
+        if not isinstance(value, str):
+            return None
+        value = value.strip()
+        if not match(value):
+            return None
+        count += 1
+        dot = value.count(".")
+        comma = value.count(",")
+        if dot and comma:
+            if value.rfind(".") > value.rfind(","):
+                return ".", ","
+            return ",", "."
+        if dot > 1:
+            thousands = "."
+        elif comma > 1:
+            thousands = ","
+        elif comma and decimal is None:
+            decimal = ","
+        elif dot and decimal is None:
+            decimal = "."
+    if not count:
+        return None
+    if thousands:
+        return ("," if thousands == "." else "."), thousands
+    return decimal or ".", None
+
+def make_number_parser(decimal, thousands=None):
+    """Returns a function parsing numbers with the given decimal mark and
+thousands separator as Decimals.  A value in another format, which the
+sample the format was guessed from can miss, is parsed with parse_float."""
+    if decimal == ",":
+        if thousands:
+            fast = lambda value: Decimal(value.replace(thousands, "").replace(",", "."))
         else:
-            return Decimal(value.replace(",", "."))
+            fast = lambda value: Decimal(value.replace(",", "."))
+    elif thousands:
+        fast = lambda value: Decimal(value.replace(thousands, ""))
+    else:
+        fast = Decimal
+    def parse(value):
+        try:
+            return fast(value)
+        except InvalidOperation:
+            return parse_float(value)
+    return parse
+
+def guess_number_parser(values):
+    """Returns a parser for a column, given a sample of its values.  Falls
+back on parse_float if the sample doesn't look like numbers."""
+    number_format = guess_number_format(values)
+    if number_format is None:
+        return parse_float
+    DEBUG_PRINT("number format", number_format)
+    return make_number_parser(*number_format)
+
+def sample_rows(rows, size=NUMBER_SAMPLE_SIZE):
+    """Returns the first size rows, and an iterable over all the rows."""
+    if isinstance(rows, list):
+        return rows[:size], rows
+    rows = iter(rows)
+    sample = list(islice(rows, size))
+    return sample, chain(sample, rows)
 
 def is_float(value):
     """Returns true if value can be parsed as flaot."""
@@ -218,134 +377,784 @@ def to_strptime(date_format, time_format, separator):
         separarator = ""
     return date_format_string + separator + time_format_string
 
+def make_datetime_parser(date_format, time_format, separator,
+                         memo_size=DATETIME_MEMO_SIZE):
+    """Returns a function parsing datetimes in the format guessed by
+guess_datetime_format, and the matching strptime format string.
+
+Zero padded values are matched with a compiled pattern and their fields
+converted straight to ints; anything else falls back to strptime.
+Results are memoized, as dates tend to repeat."""
+    strptime_format = to_strptime(date_format, time_format, separator)
+    fields = [None, None, None]
+    fields[date_format[0]] = ("year", "([0-9]{4})")
+    fields[date_format[1]] = ("month", "([0-9]{2})")
+    fields[date_format[2]] = ("day", "([0-9]{2})")
+    pattern = re.escape(date_format[3]).join(field[1] for field in fields)
+    names = [field[0] for field in fields]
+    if time_format:
+        time_fields = ["([0-9]{2})"] * min(len(time_format), 3)
+        pattern += re.escape(separator) + ":".join(time_fields)
+        names += ["hour", "minute", "second"][:len(time_fields)]
+        if len(time_format) == 4:
+            pattern += "\\.([0-9]{1,6})"
+            names.append("microsecond")
+    match = re.compile(pattern).fullmatch
+    year = names.index("year")
+    month = names.index("month")
+    day = names.index("day")
+    time_ = len(names) > 3
+    microsecond = "microsecond" in names
+    strptime = datetime.strptime
+    @lru_cache(maxsize=memo_size)
+    def parse(value):
+        matched = match(value)
+        if matched is None:
+            return strptime(value, strptime_format)
+        groups = matched.groups()
+        if not time_:
+            return datetime(int(groups[year]), int(groups[month]),
+                            int(groups[day]))
+        time_fields = list(map(int, groups[3:6]))
+        if microsecond:
+            time_fields.append(int(groups[6].ljust(6, "0")))
+        return datetime(int(groups[year]), int(groups[month]),
+                        int(groups[day]), *time_fields)
+    return parse, strptime_format
+
+def guess_datetime_format_sample(datetimes, size=DATETIME_SAMPLE_SIZE):
+    """Guesses the datetime format from the first size datetimes, and if
+that is ambiguous, from four times as many, and so on up to all of them."""
+    datetimes = iter(datetimes)
+    sample = list(islice(datetimes, size))
+    while True:
+        try:
+            return guess_datetime_format(sample)
+        except ValueError:
+            more = list(islice(datetimes, size * 3))
+            if not more:
+                raise
+            DEBUG_PRINT("Datetime format ambiguous in", len(sample), "rows")
+            sample.extend(more)
+            size *= 4
+
+def dialect_datetime_format(dialect, field):
+    """Returns the datetime format a dialect profile (see dialect.py) has
+for field, or None if there is no profile or field isn't its date field."""
+    if dialect and dialect["columns"] and \
+       field % dialect["columns"] == dialect["date field"]:
+        return dialect["date format"]
+    return None
+
+def dialect_number_format(dialect, field):
+    """Returns the number format (as guess_number_format) a dialect profile
+has for a column, or None."""
+    if not dialect or not dialect["columns"]:
+        return None
+    number_format = dialect["number formats"].get(str(field % dialect["columns"]))
+    return tuple(number_format) if number_format else None
+
+def guess_datetime_parser(datetimes):
+    """Returns a parser for, and the strptime format of, an iterable of
+datetimes, guessed from a sample (see guess_datetime_format_sample)."""
+    return make_datetime_parser(*guess_datetime_format_sample(datetimes))
+
+def _token_pattern(separator):
+    """Returns a compiled pattern splitting a row into quotes, separators
+and runs of plain text."""
+    try:
+        return _TOKEN_PATTERNS[separator]
+    except KeyError:
+        pattern = re.compile("([\"'%s])" % re.escape(separator))
+        _TOKEN_PATTERNS[separator] = pattern
+        return pattern
+
 def split_with_quotes(csv_row, separator):
-    """Returns a row split on columns, respecting quotes."""
-    DEBUG_PRINT("separator", separator)
+    """Returns a row split on columns, respecting quotes.
+
+Rows without quotes, or with every column double quoted, are split with
+str.split.  Other rows are tokenized into quotes, separators and runs of
+plain text, so that the quote rules are applied per token instead of per
+character."""
+    if "'" not in csv_row:
+        if '"' not in csv_row:
+            return csv_row.split(separator)
+        if len(csv_row) > 1 and csv_row[0] == '"' and csv_row[-1] == '"':
+            # Every column double quoted, the most common layout
+            columns = csv_row[1:-1].split('"' + separator + '"')
+            for column in columns:
+                if '"' in column:
+                    break
+            else:
+                columns.append("")
+                return columns
     columns = []
     column = ""
     in_double_quotes = False
     in_single_quotes = False
     previous = ""
-    for character in csv_row:
-        if character == '"':
+    for token in _token_pattern(separator).split(csv_row):
+        if not token:
+            continue
+        if token == '"':
             if in_double_quotes:
-                DEBUG_PRINT("column idq:", column)
                 columns.append(column)
                 column = ""
                 in_double_quotes = False
-                end_quote = True
-                previous = character
-                continue
+                previous = token
             else:
                 in_double_quotes = True
-                continue
-        elif character == "'":
+        elif token == "'":
             if in_single_quotes:
                 columns.append(column)
-                DEBUG_PRINT("column isq:", column)
                 column = ""
                 in_single_quotes = False
-                previous = character
-                continue
             else:
                 in_single_quotes = True
-                previous = character
-                continue
-        elif character == separator:
+            previous = token
+        elif token == separator:
             if in_double_quotes or in_single_quotes:
-                column += character
-                previous = character
-                continue
-            else:
-                if previous in ('"', "'"):
-                    continue
-                DEBUG_PRINT("column is:", column)
+                column += token
+                previous = token
+            elif previous not in ('"', "'"):
                 columns.append(column)
                 column = ""
-                continue
         else:
-            column += character
-            previous = character
-    DEBUG_PRINT("column ie:", column)
+            column += token
+            previous = token[-1]
     columns.append(column)
-    column = ""
     return columns
 
 def sort_lines(csv_lines, datetime_=True, field=0, keep_datetime_objects=False,
                expect_quotes=True):
     """Sorts CSV lines based on a field."""
     separator = guess_separator(csv_lines)
-    has_header = SNIFFER.has_header("\n".join(csv_lines[0:3]))
-    DEBUG_PRINT("Has header", has_header)
-    if has_header:
+    header = has_header(csv_lines)
+    DEBUG_PRINT("Has header", header)
+    if header:
         csv_lines.pop(0)
     if not expect_quotes:
         for index in range(len(csv_lines)):
             csv_lines[index] = csv_lines[index].split(separator)
     else:
-        print("expecting quotes")
+        DEBUG_PRINT("expecting quotes")
         for index in range(len(csv_lines)):
             csv_lines[index] = split_with_quotes(csv_lines[index], separator)
-    #print(csv_lines[0])
-    #print(csv_lines[-1])
-    #print(list(map(lambda x: len(x), csv_lines)))
+    sort_rows(csv_lines, datetime_=datetime_, field=field,
+              keep_datetime_objects=keep_datetime_objects)
+    return separator
+
+def sort_rows(rows, datetime_=True, field=0, keep_datetime_objects=False,
+              datetime_range=None, datetime_format=None):
+    """Sorts rows that are already split on columns, based on a field.
+With a datetime_range (see make_datetime_range), rows outside it are
+removed before sorting.  The datetime format is guessed unless given."""
     if datetime_:
-        date_format, time_format, datetime_separator = \
-          guess_datetime_format(map(lambda x: x[field], csv_lines))
-        strptime_format = to_strptime(date_format, time_format, datetime_separator)
+        with profiling.stage("date detection"):
+            if datetime_format:
+                parse, strptime_format = make_datetime_parser(*datetime_format)
+            else:
+                parse, strptime_format = \
+                  guess_datetime_parser(map(lambda x: x[field], rows))
         DEBUG_PRINT("strptime_format", strptime_format)
-        for index in range(len(csv_lines)):
-            csv_lines[index][field] = datetime.strptime(csv_lines[index][field],
-                                                        strptime_format)
-    csv_lines.sort(key=lambda x: x[field])
+        with profiling.stage("date parsing"):
+            for row in rows:
+                row[field] = parse(row[field])
+        memo = parse.cache_info()
+        profiling.count("date memo hits", memo.hits)
+        profiling.count("date memo misses", memo.misses)
+        if datetime_range:
+            rows[:] = in_datetime_range(rows, field, datetime_range)
+    with profiling.stage("sorting"):
+        rows.sort(key=lambda x: x[field])
     if not keep_datetime_objects:
-        for index in range(len(csv_lines)):
-            csv_lines[index][field] = csv_lines[index][field].strftime(strptime_format)
-    return separator
+        with profiling.stage("date formatting"):
+            for row in rows:
+                row[field] = row[field].strftime(strptime_format)
+
+def sort_rows_external(rows, datetime_=True, field=0,
+                       keep_datetime_objects=False, chunk_size=1000000,
+                       datetime_range=None, datetime_format=None):
+    """Sorts rows that don't fit in memory, based on a field.
+
+Rows are read chunk_size at a time, each chunk is sorted and written to a
+temporary run file, and an iterator k-way merging the runs is returned.
+The datetime format is guessed, unless given, from a sample read before
+chunking, widened as guess_datetime_format_sample does, so it doesn't
+depend on chunk_size.  If all the rows fit in the first chunk, the sorted
+chunk is returned as a list.  Rows outside datetime_range are dropped
+from each chunk before it is sorted."""
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        return []
+    rows = chain([first], rows)
+    if datetime_ and not datetime_format:
+        sample = []
+        def dates():
+            for row in rows:
+                sample.append(row)
+                yield row[field]
+        datetime_format = guess_datetime_format_sample(dates())
+        rows = chain(sample, rows)
+    chunk = list(islice(rows, chunk_size))
+    if datetime_:
+        parse, strptime_format = make_datetime_parser(*datetime_format)
+        DEBUG_PRINT("strptime_format", strptime_format)
+    runs = []
+    key = itemgetter(field)
+    while chunk:
+        last_chunk = len(chunk) < chunk_size
+        if datetime_:
+            for row in chunk:
+                row[field] = parse(row[field])
+            if datetime_range:
+                chunk = in_datetime_range(chunk, field, datetime_range)
+        chunk.sort(key=key)
+        if not runs and last_chunk:
+            # Everything fit in memory after all
+            if not keep_datetime_objects:
+                for row in chunk:
+                    row[field] = row[field].strftime(strptime_format)
+            return chunk
+        runs.append(write_run(chunk))
+        DEBUG_PRINT("Wrote sorted run", len(runs))
+        chunk = list(islice(rows, chunk_size))
+    merged = heapq.merge(*map(read_run, runs), key=key)
+    if keep_datetime_objects:
+        return merged
+    return format_datetime_field(merged, field, strptime_format)
+
+def write_run(rows, run=None):
+    """Writes sorted rows to a run file, a temporary one unless given, and
+returns the file."""
+    if run is None:
+        run = tempfile.TemporaryFile()
+    for index in range(0, len(rows), RUN_BATCH_SIZE):
+        pickle.dump(rows[index:index + RUN_BATCH_SIZE], run,
+                    pickle.HIGHEST_PROTOCOL)
+    run.seek(0)
+    return run
+
+def read_run(run):
+    """Generator yielding the rows of a run file, closing it when done."""
+    with run:
+        while True:
+            try:
+                rows = pickle.load(run)
+            except EOFError:
+                return
+            yield from rows
+
+def read_run_file(path):
+    """Generator yielding the rows of a run file written by a worker (see
+parse_byte_range), removing it when done."""
+    try:
+        yield from read_run(open(path, "rb"))
+    finally:
+        os.remove(path)
+
+def format_datetime_field(rows, field, strptime_format):
+    """Generator turning the datetime in field back into a string."""
+    for row in rows:
+        row[field] = row[field].strftime(strptime_format)
+        yield row
 
-def print_sort_lines(filename):
-    lines, separator = get_sorted_lines(filename)
+def read_rows(file, separator, expect_quotes=True, skip_header=None,
+              columns=None):
+    """Generator yielding the rows of a CSV file split on columns, reading
+one line at a time from the (buffered) file, or any iterable of lines.
+
+If skip_header is None, the first lines are checked for a header.  If
+columns is a list of column indexes, rows only hold those columns, in
+that order."""
+    head = list(islice(file, 3))
+    if skip_header is None:
+        skip_header = has_header([line.rstrip() for line in head])
+        DEBUG_PRINT("Has header", skip_header)
+    lines = chain(head, file)
+    if skip_header and head:
+        next(lines)
+    if expect_quotes:
+        split = split_with_quotes
+    else:
+        split = str.split
+    if columns is not None:
+        pick = column_picker(columns)
+        for line in lines:
+            yield pick(split(line.rstrip(), separator))
+        return
+    for line in lines:
+        yield split(line.rstrip(), separator)
+
+def column_picker(columns):
+    """Returns a function returning a list of columns of a row."""
+    if len(columns) == 1:
+        index = columns[0]
+        return lambda row: [row[index]]
+    getter = itemgetter(*columns)
+    return lambda row: list(getter(row))
+
+def column_position(columns, field):
+    """Returns where field is in rows holding only columns."""
+    if columns is None:
+        return field
+    try:
+        return list(columns).index(field)
+    except ValueError:
+        raise ValueError("Field not in columns", field, columns)
+
+def row_width(filename, expect_quotes=True, dialect=None):
+    """Returns the number of columns in the rows of a file, or of a source
+in a store, going by its first row."""
+    location = store_location(filename)
+    if location is not None:
+        # Imported here, as store is built on this module
+        import store
+        return store.row_width(location)
+    if binary.is_binary(filename):
+        with open(filename, "rb") as file:
+            return len(binary.read_header(file)["types"])
+    if dialect and dialect["columns"]:
+        return dialect["columns"]
+    with open(filename, "r") as file:
+        separator, lines = guess_separator_lines(file)
+        row = next(read_rows(lines, separator, expect_quotes=expect_quotes), [])
+    return len(row)
+
+def absolute_columns(filename, field, columns, expect_quotes=True,
+                     dialect=None):
+    """Returns field and columns, with negative indexes made absolute
+against the width of the rows of a file if some are negative and some
+aren't, so a date field given as -2 is found in columns given as 14,15."""
+    if columns is None or not mixed_signs(field, columns):
+        return field, columns
+    return absolute_indexes(field, columns,
+                            row_width(filename, expect_quotes, dialect))
+
+def mixed_signs(field, columns):
+    """Returns true if some of field and columns are negative and some
+aren't."""
+    indexes = [field] + list(columns)
+    return not (all(index < 0 for index in indexes) or
+                all(index >= 0 for index in indexes))
+
+def absolute_indexes(field, columns, width):
+    """Returns field and columns made absolute against a row width, see
+absolute_columns."""
+    if not width:
+        return field, columns
+    indexes = [field] + list(columns)
+    try:
+        field, *columns = [find_absolute_index(range(width), index)
+                           for index in indexes]
+    except IndexError:
+        raise ValueError("Columns out of range", indexes, width)
+    return field, columns
+
+def pick_columns(rows, field, columns):
+    """Returns field and columns as absolute_columns does, going by the
+width of the first of rows, and the rows with only those columns.  For
+rows read whole from a file that can only be read once, such as a pipe."""
+    if columns is None:
+        return field, columns, rows
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        return field, columns, iter(())
+    if mixed_signs(field, columns):
+        field, columns = absolute_indexes(field, columns, len(first))
+    return field, columns, map(column_picker(columns), chain([first], rows))
+
+def is_seekable(filename):
+    """Returns true if a file, or a source in a store, can be read more
+than once, so its row width can be read ahead, and columns and date
+ranges pushed down into reading it.  A pipe can't."""
+    return store_location(filename) is not None or os.path.isfile(filename)
+
+def read_dated_rows(filename, date_index=0, expect_quotes=True, columns=None,
+                    dialect=None, date_range=None):
+    """Returns an iterator over the rows of a file in file order, with the
+datetime in date_index parsed, see read_dated_file_rows.  A source in a
+store (see store.py) is read in date order instead.
+
+If date_range is a (start, end) pair of dates as for filter_on_date_range,
+only the rows within it are given, and for a source in a store, only
+they are read."""
+    datetime_range = make_datetime_range(*date_range) if date_range else None
+    location = store_location(filename)
+    if location is not None:
+        # Imported here, as store is built on this module
+        import store
+        return store.read_dated_rows(location, date_index, columns, datetime_range)
+    rows = read_dated_file_rows(filename, date_index, expect_quotes, columns,
+                                dialect)
+    if datetime_range:
+        low, high = datetime_range
+        field = column_position(columns, date_index)
+        rows = (row for row in rows if low <= row[field] < high)
+    return rows
+
+def read_dated_file_rows(filename, date_index=0, expect_quotes=True,
+                         columns=None, dialect=None):
+    """Generator yielding the rows of a CSV or binary column file in file
+order, with the datetime in date_index parsed.  The datetime format is
+guessed from a sample of the rows, unless the dialect profile has it.
+See read_rows for columns; date_index must be one of them."""
+    datetime_format = dialect_datetime_format(dialect, date_index)
+    date_index = column_position(columns, date_index)
+    if binary.is_binary(filename):
+        rows = binary.read_rows(filename, columns)
+        sample, rows = sample_rows(rows, DATETIME_SAMPLE_SIZE)
+        if sample and not isinstance(sample[0][date_index], datetime):
+            parse, strptime_format = guess_datetime_parser(
+                [row[date_index] for row in sample])
+            rows = parse_datetime_field(rows, date_index, parse)
+        yield from rows
+        return
+    with open(filename, "r") as file:
+        if dialect:
+            separator = dialect["separator"]
+            expect_quotes = dialect["quoting"]
+            lines = file
+        else:
+            with profiling.stage("separator detection"):
+                separator, lines = guess_separator_lines(file)
+        rows = read_rows(lines, separator, expect_quotes=expect_quotes,
+                         columns=columns,
+                         skip_header=dialect["header"] if dialect else None)
+        sample, rows = sample_rows(rows, DATETIME_SAMPLE_SIZE)
+        if not sample:
+            return
+        with profiling.stage("date detection"):
+            if datetime_format:
+                parse, strptime_format = make_datetime_parser(*datetime_format)
+            else:
+                parse, strptime_format = guess_datetime_parser(
+                    [row[date_index] for row in sample])
+        DEBUG_PRINT("strptime_format", strptime_format)
+        for row in rows:
+            row[date_index] = parse(row[date_index])
+            yield row
+
+def print_sort_lines(filename, chunk_size=None, workers=None):
+    lines, separator = get_sorted_lines(filename, chunk_size=chunk_size,
+                                        workers=workers)
     for line in lines:
         print(separator.join(line))
 
 def get_sorted_lines(filename, sort_field=0, keep_datetime_objects=False,
-                     expect_quotes=True):
-    return get_sorted_lines_file(open(filename, "r"),
-                                 sort_field=sort_field,
-                                 keep_datetime_objects=keep_datetime_objects,
-                                 expect_quotes=expect_quotes)
-       
+                     expect_quotes=True, chunk_size=None, workers=None,
+                     columns=None, date_range=None, dialect=None, mapped=False):
+    """Returns the rows of a CSV file sorted on sort_field, and the
+separator.  See get_sorted_lines_file, get_sorted_lines_parallel for
+when workers is more than 1, mapped.get_sorted_lines_mapped for when
+mapped is true, and store.get_sorted_lines_store for a filename of the
+form sqlite:PATH#SOURCE.
+
+If columns is a list of column indexes, rows only hold those columns, in
+that order, and sort_field must be one of them (as given in columns).  If
+date_range is a (start, end) pair of dates as for filter_on_date_range,
+rows outside it are dropped before sorting.  With a dialect profile (see
+dialect.py), the separator, header and datetime format aren't detected."""
+    if date_range:
+        date_range = make_datetime_range(*date_range)
+    location = store_location(filename)
+    if location is not None:
+        # Imported here, as store is built on this module
+        from store import get_sorted_lines_store
+        return get_sorted_lines_store(location, sort_field=sort_field,
+                                      keep_datetime_objects=keep_datetime_objects,
+                                      columns=columns,
+                                      datetime_range=date_range)
+    if binary.is_binary(filename):
+        return get_sorted_lines_binary(filename, sort_field=sort_field,
+                                       keep_datetime_objects=keep_datetime_objects,
+                                       columns=columns,
+                                       datetime_range=date_range)
+    if mapped:
+        # Imported here, as mapped is built on this module
+        from mapped import get_sorted_lines_mapped
+        return get_sorted_lines_mapped(filename, sort_field=sort_field,
+                                       keep_datetime_objects=keep_datetime_objects,
+                                       expect_quotes=expect_quotes,
+                                       columns=columns,
+                                       datetime_range=date_range,
+                                       dialect=dialect)
+    if workers and workers > 1:
+        return get_sorted_lines_parallel(filename, workers,
+                                         sort_field=sort_field,
+                                         keep_datetime_objects=keep_datetime_objects,
+                                         expect_quotes=expect_quotes,
+                                         chunk_size=chunk_size,
+                                         columns=columns,
+                                         datetime_range=date_range,
+                                         dialect=dialect)
+    with open(filename, "r") as file:
+        return get_sorted_lines_file(file,
+                                     sort_field=sort_field,
+                                     keep_datetime_objects=keep_datetime_objects,
+                                     expect_quotes=expect_quotes,
+                                     chunk_size=chunk_size,
+                                     columns=columns,
+                                     datetime_range=date_range,
+                                     dialect=dialect)
+
+def get_sorted_lines_binary(filename, sort_field=0, keep_datetime_objects=False,
+                            columns=None, datetime_range=None):
+    """Like get_sorted_lines, for a binary column file (see binary.py).
+Datetimes are formatted as by str if not kept."""
+    rows, separator = binary.read(filename, columns)
+    field = column_position(columns, sort_field)
+    if rows and not isinstance(rows[0][field], datetime):
+        parse, strptime_format = guess_datetime_parser(row[field] for row in rows)
+        rows = list(parse_datetime_field(rows, field, parse))
+    if datetime_range:
+        rows = in_datetime_range(rows, field, datetime_range)
+    profiling.count("rows", len(rows))
+    with profiling.stage("sorting"):
+        rows.sort(key=itemgetter(field))
+    if not keep_datetime_objects:
+        for row in rows:
+            row[field] = str(row[field])
+    return rows, separator
+
+def parse_datetime_field(rows, field, parse):
+    """Generator parsing the datetime in field with parse."""
+    for row in rows:
+        row[field] = parse(row[field])
+        yield row
+
+def get_sorted_lines_parallel(filename, workers, sort_field=0,
+                              keep_datetime_objects=False, expect_quotes=True,
+                              chunk_size=None, columns=None,
+                              datetime_range=None, dialect=None):
+    """Like get_sorted_lines, but splits the file at line boundaries into
+byte ranges that are parsed, date converted and sorted in a pool of
+worker processes, then merges the sorted ranges.
+
+With chunk_size, the ranges are made small enough to hold about
+chunk_size rows each, going by the length of the first lines, and the
+workers write them to temporary run files that are merged from disk, as
+in sort_rows_external, so the rows returned are an iterator.
+
+Quotes can't span lines (lines are split before columns), so splitting at
+line boundaries is safe.  The separator, header and datetime format are
+detected up front, the datetime format from the first lines.  If those
+don't settle the datetime format, the file is parsed serially."""
+    try:
+        separator, start, datetime_format, encoding = \
+          detect_file_format(filename, sort_field, expect_quotes, dialect)
+    except ValueError:
+        DEBUG_PRINT("Datetime format not settled by sample, parsing serially")
+        with open(filename, "r") as file:
+            return get_sorted_lines_file(file, sort_field=sort_field,
+                                         keep_datetime_objects=keep_datetime_objects,
+                                         expect_quotes=expect_quotes,
+                                         chunk_size=chunk_size,
+                                         columns=columns,
+                                         datetime_range=datetime_range,
+                                         dialect=dialect)
+    if dialect:
+        expect_quotes = dialect["quoting"]
+    if expect_quotes:
+        DEBUG_PRINT("expecting quotes")
+    count = workers * 4
+    if chunk_size:
+        count = max(count, ranges_for_chunks(filename, start, chunk_size))
+    ranges = split_byte_ranges(filename, start, count)
+    with profiling.stage("parallel parsing"):
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(parse_byte_range, filename, range_start,
+                                       range_end, separator, expect_quotes,
+                                       sort_field, datetime_format, encoding,
+                                       columns, datetime_range, bool(chunk_size))
+                       for range_start, range_end in ranges]
+            parts = [future.result() for future in futures]
+    field = column_position(columns, sort_field)
+    profiling.count("bytes", os.path.getsize(filename))
+    if chunk_size:
+        DEBUG_PRINT("Merging", len(parts), "sorted runs")
+        merged = heapq.merge(*map(read_run_file, parts), key=itemgetter(field))
+        if keep_datetime_objects:
+            return merged, separator
+        return format_datetime_field(merged, field,
+                                     to_strptime(*datetime_format)), separator
+    with profiling.stage("merging"):
+        rows = list(heapq.merge(*parts, key=itemgetter(field)))
+    profiling.count("rows", len(rows))
+    if not keep_datetime_objects:
+        strptime_format = to_strptime(*datetime_format)
+        for row in rows:
+            row[field] = row[field].strftime(strptime_format)
+    return rows, separator
+
+def detect_file_format(filename, field=0, expect_quotes=True, dialect=None):
+    """Returns the separator, the byte offset of the first row after any
+header, the datetime format (as guess_datetime_format) of field guessed
+from the first rows, and the encoding of a file.  What the dialect
+profile has, if given, isn't detected.
+
+Raises ValueError if the first rows don't settle the datetime format."""
+    with open(filename, "r") as file:
+        encoding = file.encoding
+        separator = dialect["separator"] if dialect else guess_separator_file(file)
+    with open(filename, "rb") as file:
+        head = list(islice(file, 3))
+        if dialect:
+            skip_header = dialect["header"]
+        else:
+            skip_header = has_header([line.decode(encoding).rstrip()
+                                      for line in head])
+        start = len(head[0]) if skip_header and head else 0
+        datetime_format = dialect_datetime_format(dialect, field)
+        if datetime_format:
+            return separator, start, datetime_format, encoding
+        file.seek(start)
+        sample = [line.decode(encoding).rstrip()
+                  for line in islice(file, DATETIME_SAMPLE_SIZE)]
+    split = split_with_quotes if expect_quotes else str.split
+    datetime_format = guess_datetime_format(
+        split(line, separator)[field] for line in sample)
+    return separator, start, datetime_format, encoding
+
+def ranges_for_chunks(filename, start, chunk_size):
+    """Returns how many byte ranges of a file from start hold about
+chunk_size lines each, going by the length of its first lines."""
+    with open(filename, "rb") as file:
+        file.seek(start)
+        sample = list(islice(file, SEPARATOR_SAMPLE_LINES))
+    if not sample:
+        return 1
+    line_size = sum(map(len, sample)) / len(sample)
+    size = os.path.getsize(filename) - start
+    return -int(-size // (line_size * chunk_size))
+
+def split_byte_ranges(filename, start, count):
+    """Returns up to count (start, end) byte ranges covering a file from
+start, each beginning at the start of a line."""
+    size = os.path.getsize(filename)
+    boundaries = [start]
+    with open(filename, "rb") as file:
+        for index in range(1, count):
+            offset = start + (size - start) * index // count
+            if offset <= boundaries[-1]:
+                continue
+            file.seek(offset)
+            file.readline()
+            offset = file.tell()
+            if offset >= size:
+                break
+            if offset > boundaries[-1]:
+                boundaries.append(offset)
+    boundaries.append(size)
+    return [(range_start, range_end)
+            for range_start, range_end in zip(boundaries, boundaries[1:])
+            if range_end > range_start]
+
+def parse_byte_range(filename, start, end, separator, expect_quotes, field,
+                     datetime_format, encoding, columns=None,
+                     datetime_range=None, spill=False):
+    """Returns the rows in a byte range of a file, split on columns, with
+the datetime in field parsed and sorted on.  Run in worker processes.
+See read_rows for columns, and sort_rows for datetime_range.  If spill is
+true, the rows are written to a run file (see write_run), and its path is
+returned instead."""
+    with open(filename, "rb") as file:
+        file.seek(start)
+        text = file.read(end - start).decode(encoding)
+    # Universal newlines, as when reading the file in text mode
+    lines = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    if lines and not lines[-1]:
+        lines.pop()
+    split = split_with_quotes if expect_quotes else str.split
+    rows = [split(line.rstrip(), separator) for line in lines]
+    if columns is not None:
+        rows = list(map(column_picker(columns), rows))
+        field = column_position(columns, field)
+    parse, strptime_format = make_datetime_parser(*datetime_format)
+    for row in rows:
+        row[field] = parse(row[field])
+    if datetime_range:
+        rows = in_datetime_range(rows, field, datetime_range)
+    rows.sort(key=itemgetter(field))
+    if not spill:
+        return rows
+    descriptor, path = tempfile.mkstemp(suffix=".run")
+    with os.fdopen(descriptor, "wb") as run:
+        write_run(rows, run)
+    return path
+
 def get_sorted_lines_file(file, sort_field=0, keep_datetime_objects=False,
-                          expect_quotes=True):
-    lines = file.readlines()
-    return sort_lines_wrapper(lines, sort_field=sort_field,
-                              keep_datetime_objects=keep_datetime_objects,
-                              expect_quotes=expect_quotes)
-
-def sort_lines_wrapper(lines, sort_field=0, keep_datetime_objects=False,
-                       expect_quotes=True):
-    for index in range(len(lines)):
-        lines[index] = lines[index].rstrip()
-    separator = sort_lines(lines, field=sort_field,
-                           keep_datetime_objects=keep_datetime_objects,
-                           expect_quotes=expect_quotes)
-    return lines, separator
-
-def render_csv_lines(lines, separator=",", string_type=type("")):
-    new_lines = []
+                          expect_quotes=True, chunk_size=None, columns=None,
+                          datetime_range=None, dialect=None):
+    """Returns the rows of a CSV file sorted on sort_field, and the
+separator.  The file is streamed through read_rows, so only the parsed
+rows are kept in memory.
+
+If chunk_size is given, rows are sorted chunk_size at a time and merged
+from temporary files (see sort_rows_external), and the rows returned can
+be an iterator instead of a list.  See get_sorted_lines for columns and
+dialect, and sort_rows for datetime_range."""
+    if dialect:
+        separator = dialect["separator"]
+        expect_quotes = dialect["quoting"]
+        lines = file
+    else:
+        with profiling.stage("separator detection"):
+            separator, lines = guess_separator_lines(file)
+    if file.seekable():
+        profiling.count("bytes", os.fstat(file.fileno()).st_size)
+    if expect_quotes:
+        DEBUG_PRINT("expecting quotes")
+    rows = read_rows(lines, separator, expect_quotes=expect_quotes,
+                     columns=columns,
+                     skip_header=dialect["header"] if dialect else None)
+    field = column_position(columns, sort_field)
+    datetime_format = dialect_datetime_format(dialect, sort_field)
+    if chunk_size:
+        with profiling.stage("external sorting"):
+            rows = sort_rows_external(rows, field=field,
+                                      keep_datetime_objects=keep_datetime_objects,
+                                      chunk_size=chunk_size,
+                                      datetime_range=datetime_range,
+                                      datetime_format=datetime_format)
+        return rows, separator
+    with profiling.stage("splitting"):
+        rows = list(rows)
+    profiling.count("rows", len(rows))
+    sort_rows(rows, field=field,
+              keep_datetime_objects=keep_datetime_objects,
+              datetime_range=datetime_range,
+              datetime_format=datetime_format)
+    return rows, separator
+
+def write_csv_lines(lines, separator=",", file=None,
+                    buffer_size=WRITE_BUFFER_SIZE):
+    """Writes rows to a file (standard output by default), formatting each
+straight into a buffer that is written about buffer_size characters at a
+time."""
+    if file is None:
+        file = sys.stdout
+    join = separator.join
+    buffer = []
+    size = 0
     for line in lines:
-        new_line = []
-        for item in line:
-            if type(item) != string_type:
-                item = str(item)
-            new_line.append(item)
-        new_lines.append(new_line)
-    return new_lines
+        text = join(map(str, line))
+        buffer.append(text)
+        size += len(text)
+        if size >= buffer_size:
+            buffer.append("")
+            file.write("\n".join(buffer))
+            buffer = []
+            size = 0
+    if buffer:
+        buffer.append("")
+        file.write("\n".join(buffer))
 
 def print_csv_lines(lines, separator=","):
-    new_lines = render_csv_lines(lines, separator=separator)
-    for line in new_lines:
-        print(separator.join(line))
+    with profiling.stage("rendering"):
+        write_csv_lines(lines, separator)
 
 def find_absolute_index(sequence, index):
     """Returns the absolute (non-negative) position in a sequence."""
@@ -357,4 +1166,7 @@ def find_absolute_index(sequence, index):
         return len(sequence) + index
 
 if __name__ == "__main__":
-    print_sort_lines(sys.argv[1])
+    profiling.enable_from_arguments()
+    chunk_size = get_option("--sort-chunk-size", type_=int)
+    workers = get_option("--workers", type_=int)
+    print_sort_lines(sys.argv[1], chunk_size=chunk_size, workers=workers)
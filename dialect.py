@@ -0,0 +1,92 @@
+"""Dialect profiles: what format detection found out about a CSV source.
+
+A profile is a dict with the separator, whether quotes are used, whether
+there is a header, the number of columns, the date field and its
+datetime format (as guess_datetime_format) and the number format
+(decimal mark and thousands separator) of each numeric column.  It is
+saved as JSON, one file per source, such as an exchange's exports, with
+--dialect FILE: if the file exists, the profile in it is used and
+detection is skipped, otherwise the profile is detected and saved there.
+
+The readers in csv_utilities take a profile as their dialect argument,
+and only split rows with quote handling if it says quotes are used."""
+
+import json, os
+
+from itertools import chain, islice
+
+from csv_utilities import guess_separator_file, has_header, read_rows, \
+     guess_datetime_format_sample, guess_number_format, dialect_datetime_format, \
+     NUMBER_SAMPLE_SIZE
+import profiling
+from utilities import DEBUG_PRINT
+
+def has_quotes(filename, size=NUMBER_SAMPLE_SIZE):
+    """Returns true if a double or single quote is in the first size lines
+of a file after the header line, the sample the number formats are
+detected from, or in the header."""
+    with open(filename, "rb") as file:
+        return any(b'"' in line or b"'" in line
+                   for line in islice(file, size + 1))
+
+def detect(filename, date_index=0):
+    """Returns the profile of a CSV file, detected from a sample of it."""
+    with open(filename, "r") as file:
+        separator = guess_separator_file(file)
+        head = [line.rstrip() for line in islice(file, 3)]
+        file.seek(0)
+        header = has_header(head)
+        rows = read_rows(file, separator, skip_header=header)
+        sample = list(islice(rows, NUMBER_SAMPLE_SIZE))
+        columns = len(sample[0]) if sample else 0
+        date_field = date_index % columns if columns else None
+        date_format = None
+        if sample:
+            date_format = guess_datetime_format_sample(
+                row[date_index] for row in chain(sample, rows))
+    number_formats = {}
+    for index in range(columns):
+        if index == date_field:
+            continue
+        number_format = guess_number_format([row[index] for row in sample
+                                             if len(row) > index])
+        if number_format:
+            number_formats[str(index)] = number_format
+    return {"separator": separator,
+            "quoting": has_quotes(filename),
+            "header": header,
+            "columns": columns,
+            "date field": date_field,
+            "date format": date_format,
+            "number formats": number_formats}
+
+def load(profile_filename):
+    """Returns the profile saved in a file, or None if there isn't one."""
+    try:
+        with open(profile_filename, "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+def save(profile_filename, profile):
+    temporary = profile_filename + ".tmp"
+    with open(temporary, "w") as file:
+        json.dump(profile, file, indent=1)
+    os.replace(temporary, profile_filename)
+
+def get(profile_filename, filename, date_index=0):
+    """Returns the profile saved in profile_filename, or detects that of
+filename and saves it there.  Returns None without a profile_filename."""
+    if not profile_filename:
+        return None
+    profile = load(profile_filename)
+    if profile is not None and \
+       dialect_datetime_format(profile, date_index) is not None:
+        DEBUG_PRINT("Using dialect", profile_filename)
+        profiling.count("dialect hits")
+        return profile
+    with profiling.stage("dialect detection"):
+        profile = detect(filename, date_index)
+    save(profile_filename, profile)
+    DEBUG_PRINT("Saved dialect", profile_filename, profile)
+    return profile
@@ -0,0 +1,225 @@
+"""Fixed-point rounding, an opt-in alternative to plain Decimal for
+conversion and summing (--fixed-point), for results that can be
+reproduced, not for speed.
+
+Each currency has its own scale, the number of decimal places kept, and
+rates have RATE_SCALE.  The rules are:
+
+- Amounts with more decimals than the scale are rounded half to even, so
+  0.125 with scale 2 is 0.12, 0.135 is 0.14 and -0.125 is -0.12.
+  Numbers with an exponent, such as 1e3, or in another format than the
+  column's, are parsed as by csv_utilities.parse_float and rounded the
+  same way.
+- Adding and subtracting values of one scale is exact.
+- Multiplying a value by a rate is exact, and the product is then rounded
+  half to even to the scale of the currency converted to.  Each step of a
+  chain is rounded in turn, so the result doesn't depend on anything but
+  the inputs and the scales.
+- A midpoint, such as the average of a low and a high rate, is rounded
+  half to even.
+
+So results are the same on every run and platform, unlike Decimal
+results, which depend on the context precision once values get long.
+
+Conversion (Chain) works on Decimals rounded to each scale with quantize,
+in ROUNDING, which is precise enough for products to be exact.  Decimal
+does that in C, while ints would have to be rounded in Python, so it is
+as quick as it gets, but still slower than plain Decimal conversion.
+Sums (Stats) are kept as ints scaled by 10**scale, so 12.34 with scale 4
+is 123400, and totals, and means and variances worked out from them, are
+exact until the final division."""
+
+from decimal import Context, Decimal, MAX_PREC, ROUND_HALF_EVEN, localcontext
+from itertools import repeat
+
+import csv_utilities
+from csv_utilities import parse_float
+
+SCALE = 8
+RATE_SCALE = 10
+POWERS = [10 ** exponent for exponent in range(64)]
+EXACT = Context(prec=MAX_PREC)
+# Exact products, rounded half to even by quantize
+ROUNDING = Context(prec=MAX_PREC, rounding=ROUND_HALF_EVEN)
+UNITS = [Decimal(1).scaleb(-exponent) for exponent in range(64)]
+HALF = Decimal("0.5")
+
+def make_parser(scale=SCALE, decimal=".", thousands=None):
+    """Returns a function parsing numbers, written with the given decimal
+mark and thousands separator, as ints with scale.  Other numbers are
+parsed with parse_float (see from_decimal)."""
+    multiplier = POWERS[scale]
+    padding = ["0" * (scale - decimals) for decimals in range(scale + 1)]
+    def parse(text):
+        if thousands:
+            number = text.replace(thousands, "")
+        else:
+            number = text
+        whole, _, fraction = number.strip().partition(decimal)
+        try:
+            if not fraction:
+                return int(whole) * multiplier
+            if len(fraction) <= scale:
+                return int(whole + fraction + padding[len(fraction)])
+            return round_shift(int(whole + fraction), len(fraction) - scale)
+        except ValueError:
+            return from_decimal(parse_float(text), scale)
+    return parse
+
+def make_number_parser(scale=SCALE, number_format=None):
+    """Returns a parser for numbers in number_format, a (decimal mark,
+thousands separator) pair as csv_utilities.guess_number_format returns,
+or like csv_utilities.parse_float if it is None."""
+    if number_format is not None:
+        return make_parser(scale, *number_format)
+    return make_parser(scale)
+
+def from_decimal(value, scale=SCALE):
+    """Returns a Decimal as an int with scale, rounded half to even."""
+    if not value.is_finite():
+        raise ValueError("Not a finite number", value)
+    return int(value.scaleb(scale, EXACT).to_integral_value(ROUND_HALF_EVEN, EXACT))
+
+def round_shift(value, shift):
+    """Returns value / 10**shift rounded half to even."""
+    if shift <= 0:
+        return value * POWERS[-shift]
+    divisor = POWERS[shift]
+    quotient, remainder = divmod(value + (divisor >> 1), divisor)
+    if not remainder and quotient & 1:
+        return quotient - 1
+    return quotient
+
+def round_decimal(value, scale=SCALE):
+    """Returns a finite Decimal rounded half to even to scale, 0 rather
+than -0 if a negative value rounds to zero."""
+    if not value.is_finite():
+        raise ValueError("Not a finite number", value)
+    rounded = value.quantize(UNITS[scale], context=ROUNDING)
+    return rounded or rounded.copy_abs()
+
+def make_decimal_parser(scale=SCALE, number_format=None):
+    """Returns a parser for numbers in number_format, as make_number_parser,
+giving Decimals rounded to scale instead of ints."""
+    if number_format is not None:
+        parse = csv_utilities.make_number_parser(*number_format)
+    else:
+        parse = parse_float
+    return lambda text: round_decimal(parse(text), scale)
+
+def midpoint(low, high, scale=RATE_SCALE):
+    """Returns (low + high) / 2 of Decimals rounded half to even to scale."""
+    return round_decimal((low + high) * HALF, scale)
+
+def plain(value):
+    """Returns a Decimal without trailing zeros or an exponent, so a
+result prints as with plain Decimal, 0 rather than 0E-8."""
+    return Decimal(format(value.normalize(EXACT), "f"))
+
+def to_decimal(value, scale=SCALE):
+    """Returns an int with scale as the same Decimal."""
+    return Decimal(value).scaleb(-scale, EXACT)
+
+def round_column(values, scale):
+    """Returns Decimals rounded half to even to scale, in the context in
+effect, which should be ROUNDING.  A negative value rounded to zero is 0,
+as with ints, not -0."""
+    rounded = map(Decimal.quantize, values, repeat(UNITS[scale]))
+    return [value or value.copy_abs() for value in rounded]
+
+def parse_scales(text):
+    """Returns the list of scales given as 8 or 8,2,2 for --fixed-point."""
+    return [int(scale) for scale in text.split(",")]
+
+class Chain:
+    """The scales of a conversion chain: that of the amounts, and that of
+the value converted through each rate table.  The last scale given is
+used for the rest."""
+
+    def __init__(self, scales, stages, rate_scale=RATE_SCALE):
+        scales = list(scales) or [SCALE]
+        scales += scales[-1:] * (stages + 1 - len(scales))
+        self.scales = scales[:stages + 1]
+        self.rate_scale = rate_scale
+
+    def parser(self, number_format=None):
+        """Returns a parser of the amounts as Decimals, which convert
+rounds to the first scale."""
+        if number_format is not None:
+            return csv_utilities.make_number_parser(*number_format)
+        return parse_float
+
+    def convert(self, rate_tables, ordinals, column):
+        """Returns the amounts in column, and the amounts converted through
+each of rate_tables in turn, as lists of Decimals rounded to each scale.
+The rate tables are expected to have rates rounded to rate_scale, as
+rates.parse_rate_file gives them with a scale."""
+        if not all(map(Decimal.is_finite, column)):
+            raise ValueError("Not a finite number",
+                             next(value for value in column
+                                  if not value.is_finite()))
+        with localcontext(ROUNDING):
+            columns = [round_column(column, self.scales[0])]
+            for position, rates in enumerate(rate_tables):
+                products = rates.convert(ordinals, columns[-1])
+                columns.append(round_column(products, self.scales[position + 1]))
+        return columns
+
+class Stats:
+    """Like aggregate.Stats, for ints with scale.  Count, sum, sum of
+squares, min and max are kept exactly, so merging is exact too, and the
+mean and variance are worked out from them as Decimals when asked for.
+The results are plain Decimals (see plain)."""
+    __slots__ = ("scale", "count", "sum", "squares", "low", "high")
+
+    def __init__(self, scale=SCALE):
+        self.scale = scale
+        self.count = 0
+        self.sum = 0
+        self.squares = 0
+        self.low = None
+        self.high = None
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        self.squares += value * value
+        if self.low is None or value < self.low:
+            self.low = value
+        if self.high is None or value > self.high:
+            self.high = value
+
+    def merge(self, other):
+        if not other.count:
+            return
+        self.count += other.count
+        self.sum += other.sum
+        self.squares += other.squares
+        if self.low is None or other.low < self.low:
+            self.low = other.low
+        if self.high is None or other.high > self.high:
+            self.high = other.high
+
+    @property
+    def total(self):
+        return plain(to_decimal(self.sum, self.scale))
+
+    @property
+    def minimum(self):
+        return None if self.low is None else plain(to_decimal(self.low, self.scale))
+
+    @property
+    def maximum(self):
+        return None if self.high is None else plain(to_decimal(self.high, self.scale))
+
+    def average(self):
+        return plain(self.total / self.count) if self.count else None
+
+    def variance(self):
+        """Returns the sample variance, or None with less than two values.
+The numerator is exact, only the division rounds."""
+        if self.count < 2:
+            return None
+        numerator = self.count * self.squares - self.sum * self.sum
+        return plain(to_decimal(numerator, 2 * self.scale) /
+                     (self.count * (self.count - 1)))
@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+
+"""Matches disposals against acquisition lots, for realised gains.
+
+./lots.py <CSV file> <date_index,amount_index,value_index> [asset_index]
+          [--method fifo|lifo|average]
+
+The file is typically the output of process_chain.py (CSV, or binary
+with --binary), where value_index is the amount converted to the base
+currency, usually -1.  As in summarize.py, a positive amount is an
+acquisition (add) and a negative one a disposal (subtract).  Each asset
+has its own lots, all in one asset without an asset_index.
+
+Lots are kept in a deque, taken from the front for FIFO and from the back
+for LIFO; a lot only partly disposed of is split in place.  Average cost
+only keeps the quantity and cost held.  Each trade takes constant time
+apart from the lots it uses up, so matching is linear in the number of
+trades."""
+
+import sys
+
+from collections import OrderedDict, deque
+
+from csv_utilities import get_sorted_lines, guess_number_parser, parse_float, \
+     sample_rows, write_csv_lines, ZERO
+import profiling
+from utilities import get_option
+
+METHODS = ("fifo", "lifo", "average")
+
+class Lots:
+    """The lots held of one asset."""
+
+    def __init__(self, method="fifo"):
+        if method not in METHODS:
+            raise ValueError("Unknown method", method, METHODS)
+        self.method = method
+        self.lots = deque()
+        self.quantity = ZERO
+        self.cost = ZERO
+
+    def acquire(self, quantity, cost):
+        if self.method != "average":
+            self.lots.append([quantity, cost])
+        self.quantity += quantity
+        self.cost += cost
+
+    def dispose(self, quantity):
+        """Removes quantity from the lots, and returns its cost basis.
+Raises ValueError if more is disposed of than is held."""
+        if quantity > self.quantity:
+            raise ValueError("Disposing of more than held", quantity,
+                             self.quantity)
+        if self.method == "average":
+            if quantity == self.quantity:
+                basis = self.cost
+            else:
+                basis = self.cost * quantity / self.quantity
+        else:
+            basis = self.take(quantity)
+        self.quantity -= quantity
+        self.cost -= basis
+        return basis
+
+    def take(self, quantity):
+        lots = self.lots
+        if self.method == "fifo":
+            index, pop = 0, lots.popleft
+        else:
+            index, pop = -1, lots.pop
+        basis = ZERO
+        while quantity > ZERO:
+            lot = lots[index]
+            if lot[0] <= quantity:
+                quantity -= lot[0]
+                basis += lot[1]
+                pop()
+            else:
+                part = lot[1] * quantity / lot[0]
+                lot[0] -= quantity
+                lot[1] -= part
+                basis += part
+                quantity = ZERO
+        return basis
+
+def match_lots(rows, date_index=0, amount_index=1, value_index=-1,
+               asset_index=None, method="fifo", parse_amount=parse_float,
+               parse_value=parse_float):
+    """Generator yielding (datetime, asset, quantity, proceeds, cost, gain)
+for each disposal in rows sorted on date_index, and returns the Lots of
+each asset when done.  Amounts and values are parsed with parse_float
+unless other parsers are given."""
+    assets = {}
+    for row in rows:
+        amount = parse_amount(row[amount_index])
+        if not amount:
+            continue
+        value = abs(parse_value(row[value_index]))
+        asset = row[asset_index] if asset_index is not None else ""
+        lots = assets.get(asset)
+        if lots is None:
+            lots = assets[asset] = Lots(method)
+        if amount > ZERO:
+            lots.acquire(amount, value)
+            continue
+        try:
+            cost = lots.dispose(-amount)
+        except ValueError as error:
+            raise ValueError(*error.args, row[date_index], asset)
+        yield row[date_index], asset, -amount, value, cost, value - cost
+    return assets
+
+def runner():
+    profiling.enable_from_arguments()
+    method = get_option("--method", "fifo")
+    try:
+        indexes = [int(index) for index in sys.argv[2].split(",")]
+        date_index, amount_index, value_index = indexes
+    except (IndexError, ValueError):
+        print("Error, use:", sys.argv[0], "<CSV file>",
+              "date_index,amount_index,value_index [asset_index] [--method %s]"
+              % "|".join(METHODS))
+        print()
+        print("For example,", sys.argv[0], "converted.csv 0,1,-1")
+        sys.exit(1)
+    if method not in METHODS:
+        print("Error: unknown method", method, "use", "|".join(METHODS),
+              file=sys.stderr)
+        sys.exit(1)
+    try:
+        asset_index = int(sys.argv[3])
+    except IndexError:
+        asset_index = None
+    columns = [date_index, amount_index, value_index]
+    if asset_index is not None:
+        columns.append(asset_index)
+    lines, separator = get_sorted_lines(sys.argv[1], sort_field=date_index,
+                                        keep_datetime_objects=True,
+                                        columns=columns)
+    sample, lines = sample_rows(lines)
+    parse_amount = guess_number_parser([line[1] for line in sample])
+    parse_value = guess_number_parser([line[2] for line in sample])
+    disposals = match_lots(lines, 0, 1, 2, 3 if asset_index is not None else None,
+                           method=method, parse_amount=parse_amount,
+                           parse_value=parse_value)
+    totals = OrderedDict()
+    def record():
+        yield ("Date", "Asset", "Quantity", "Proceeds", "Cost", "Gain")
+        for disposal in disposals:
+            total = totals.setdefault(disposal[1], [ZERO, ZERO, ZERO])
+            for index, amount in enumerate(disposal[3:]):
+                total[index] += amount
+            yield disposal
+    try:
+        with profiling.stage("lot matching"):
+            write_csv_lines(record(), separator)
+    except ValueError as error:
+        sys.stdout.flush()
+        print("Error:", *[arg for arg in error.args if arg != ""],
+              file=sys.stderr)
+        sys.exit(1)
+    print()
+    for asset, (proceeds, cost, gain) in totals.items():
+        print("%sProceeds: %s, cost %s, gain %s" %
+              (asset + " " if asset else "", proceeds, cost, gain))
+
+if __name__ == "__main__":
+    runner()
@@ -0,0 +1,166 @@
+"""Memory mapped CSV input, with indexes for reading only some rows.
+
+A MappedFile maps a file into memory and keeps the byte offset of the
+start of each line in an array.  For the datetime field rows are sorted
+on, it also keeps each line's datetime as an int (see
+utilities.datetime_to_key), and notes whether the file is already sorted.
+With that, the lines within a date range are found with bisect in a
+sorted file, or by scanning the array otherwise, and only their bytes are
+decoded and split.  Rows are sorted on the keys, so dates aren't parsed
+again.  Both indexes are saved in the cache (see cache.py) when it is on.
+
+get_sorted_lines_mapped is what csv_utilities.get_sorted_lines(...,
+mapped=True) uses."""
+
+import mmap, re
+
+from array import array
+from bisect import bisect_left
+from itertools import islice
+
+import cache, profiling
+from csv_utilities import guess_separator_file, has_header, split_with_quotes, \
+     guess_datetime_format_sample, make_datetime_parser, dialect_datetime_format, \
+     column_picker, column_position, to_strptime
+from utilities import DEBUG_PRINT, datetime_to_key, key_to_datetime
+
+NEWLINE = re.compile(b"\n")
+BLOCK_LINES = 1 << 16
+
+class MappedFile:
+    def __init__(self, filename, expect_quotes=True, dialect=None):
+        self.filename = filename
+        with open(filename, "r") as file:
+            self.encoding = file.encoding
+            if dialect:
+                self.separator = dialect["separator"]
+                expect_quotes = dialect["quoting"]
+            else:
+                with profiling.stage("separator detection"):
+                    self.separator = guess_separator_file(file)
+            head = [line.rstrip() for line in islice(file, 3)]
+        self.header = dialect["header"] if dialect else has_header(head)
+        self.split = split_with_quotes if expect_quotes else str.split
+        self.file = open(filename, "rb")
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        with profiling.stage("line index"):
+            self.offsets = cache.cached(filename, ("line offsets",),
+                                        self.find_lines,
+                                        encode=array.tobytes,
+                                        decode=lambda data: array("q", data))
+        self.first = 1 if self.header and len(self.offsets) > 1 else 0
+        profiling.count("bytes", len(self.buffer))
+
+    def close(self):
+        self.buffer.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def find_lines(self):
+        """Returns an array of the offset of each line, and the end of the
+file, so line i is buffer[offsets[i]:offsets[i + 1]]."""
+        offsets = array("q", [0])
+        offsets.extend(match.end() for match in NEWLINE.finditer(self.buffer))
+        if offsets[-1] != len(self.buffer):
+            offsets.append(len(self.buffer))
+        return offsets
+
+    def __len__(self):
+        """Returns the number of rows, not counting any header."""
+        return len(self.offsets) - 1 - self.first
+
+    def lines(self, start, end):
+        """Returns the text of rows start to end, decoded in one slice."""
+        offsets = self.offsets
+        first = self.first
+        text = self.buffer[offsets[first + start]:offsets[first + end]]
+        lines = text.decode(self.encoding).split("\n")
+        if lines and not lines[-1]:
+            lines.pop()
+        return lines
+
+    def line(self, index):
+        offsets = self.offsets
+        index += self.first
+        return self.buffer[offsets[index]:offsets[index + 1]].decode(self.encoding)
+
+    def date_keys(self, field, datetime_format=None):
+        """Returns an array with the datetime in field of each row as an
+int, the datetime format, and whether the rows are sorted on it.  The
+keys are cached with how the rows were read, and datetime_format if
+given, as they depend on both."""
+        def build():
+            split = self.split
+            separator = self.separator
+            def dates():
+                for start in range(0, len(self), BLOCK_LINES):
+                    for line in self.lines(start, min(start + BLOCK_LINES, len(self))):
+                        yield split(line.rstrip(), separator)[field]
+            format_ = datetime_format or guess_datetime_format_sample(dates())
+            parse, strptime_format = make_datetime_parser(*format_)
+            keys = array("q", (datetime_to_key(parse(date)) for date in dates()))
+            ordered = all(keys[index] <= keys[index + 1]
+                          for index in range(len(keys) - 1))
+            return keys.tobytes(), format_, ordered
+        with profiling.stage("date index"):
+            spec = ("date keys", field, self.header, self.separator,
+                    self.split is split_with_quotes, datetime_format)
+            data, format_, ordered = cache.cached(self.filename, spec, build)
+        keys = array("q")
+        keys.frombytes(data)
+        DEBUG_PRINT("Date index", self.filename, len(keys), "sorted" if ordered else "")
+        return keys, format_, ordered
+
+def get_sorted_lines_mapped(filename, sort_field=0, keep_datetime_objects=False,
+                            expect_quotes=True, columns=None,
+                            datetime_range=None, dialect=None):
+    """Like csv_utilities.get_sorted_lines, reading a memory mapped file
+through its indexes.  Only the rows within datetime_range are decoded."""
+    with open(filename, "rb") as file:
+        if not file.read(1):
+            return [], ","
+    with MappedFile(filename, expect_quotes, dialect) as mapped:
+        keys, datetime_format, ordered = mapped.date_keys(
+            sort_field, dialect_datetime_format(dialect, sort_field))
+        with profiling.stage("selecting"):
+            if ordered:
+                start, end = 0, len(keys)
+                if datetime_range:
+                    start = bisect_left(keys, datetime_to_key(datetime_range[0]))
+                    end = bisect_left(keys, datetime_to_key(datetime_range[1]))
+                selected = None
+            else:
+                selected = range(len(keys))
+                if datetime_range:
+                    low, high = map(datetime_to_key, datetime_range)
+                    selected = [index for index in selected
+                                if low <= keys[index] < high]
+                selected = sorted(selected, key=keys.__getitem__)
+        split = mapped.split
+        separator = mapped.separator
+        pick = column_picker(columns) if columns is not None else None
+        field = column_position(columns, sort_field)
+        with profiling.stage("splitting"):
+            if selected is None:
+                lines = mapped.lines(start, end)
+                selected = range(start, end)
+            else:
+                lines = map(mapped.line, selected)
+            rows = []
+            for index, line in zip(selected, lines):
+                row = split(line.rstrip(), separator)
+                if pick:
+                    row = pick(row)
+                row[field] = key_to_datetime(keys[index])
+                rows.append(row)
+    profiling.count("rows", len(rows))
+    if not keep_datetime_objects:
+        strptime_format = to_strptime(*datetime_format)
+        for row in rows:
+            row[field] = row[field].strftime(strptime_format)
+    return rows, mapped.separator
@@ -1,46 +1,101 @@
 #!/usr/bin/python3
 
-import csv, sys
+import sys
 
-from decimal import Decimal
-from collections import OrderedDict
-from datetime import date as Date
-from datetime import timedelta
+import cache, dialect, fixed_point, profiling
+from aggregate import Aggregator
+from csv_utilities import get_sorted_lines, guess_number_format, make_number_parser, sample_rows, find_absolute_index, \
+     read_dated_rows, column_position, absolute_columns, is_seekable, pick_columns
 
-from csv_utilities import get_sorted_lines, parse_float, is_float, find_absolute_index, filter_on_date_range
+from utilities import DEBUG_PRINT, get_flag, get_option
 
-from utilities import DEBUG_PRINT
-
-def parse_mda_file(filename, date_index=0, start=None, end=None):
-    dates = OrderedDict()
-    indexes = float_fields = []
-    lines, separator = get_sorted_lines(filename, sort_field=date_index,
-                                        keep_datetime_objects=True)
-    if start and end:
-        lines = filter_on_date_range(start, end, lines, date_index=date_index)
-    for line in lines:
-        date = line[date_index].date()
-        values = []
-        if not indexes:
-            indexes = list(range(len(line)))
-            try:
-                indexes.remove(find_absolute_index(line, date_index))
-            except ValueError:
-                print("Can't remove index", (indexes, date_index))
-                raise
-        if not float_fields:
-            for index in indexes:
-                if is_float(line[index]):
-                    float_fields.append(index)
-                else:
-                    DEBUG_PRINT("not float", line[index])
-        for index in float_fields:
-            values.append(parse_float(line[index]))
-        dates[date] = values
-    return dates
+def guess_column_parsers(sample, date_index=0, scale=None):
+    """Returns a list of (index, number parser) of the columns that look
+numeric in a sample of rows, leaving out the date column.  With a scale,
+the parsers give fixed-point ints (see fixed_point.py)."""
+    indexes = list(range(len(sample[0])))
+    try:
+        indexes.remove(find_absolute_index(sample[0], date_index))
+    except ValueError:
+        print("Can't remove index", (indexes, date_index))
+        raise
+    parsers = []
+    for index in indexes:
+        number_format = guess_number_format([line[index] for line in sample])
+        if number_format and scale is not None:
+            parsers.append((index, fixed_point.make_number_parser(scale,
+                                                                   number_format)))
+        elif number_format:
+            parsers.append((index, make_number_parser(*number_format)))
+        else:
+            DEBUG_PRINT("not float", sample[0][index])
+    return parsers
 
+def aggregate_mda_file(filename, date_index=0, start=None, end=None,
+                       windows=("all",), columns=None, dialect=None,
+                       mapped=False, scale=None, chunk_size=None,
+                       workers=None):
+    """Returns an Aggregator (see aggregate.py) of the numeric columns of a
+file, and the indexes of those columns.  The rows are read in one pass,
+in file order, and not kept, unless mapped is true, when only the rows
+within the date range are read from the memory mapped file, or workers
+or chunk_size are given, when the file is read with them by
+csv_utilities.get_sorted_lines.  A pipe is always read in one pass.  The
+date range is pushed down into the query for a source in a store.  See
+csv_utilities.get_sorted_lines for columns and dialect.  With a scale,
+the columns are summed as fixed-point ints, in fixed_point.Stats."""
+    seekable = is_seekable(filename)
+    if seekable:
+        date_index, columns = absolute_columns(filename, date_index, columns,
+                                               dialect=dialect)
+    if not seekable:
+        # Read whole, as a pipe is read once, and picked after parsing
+        rows = read_dated_rows(filename, date_index=date_index,
+                               dialect=dialect,
+                               date_range=(start, end) if start and end else None)
+        date_index, columns, rows = pick_columns(rows, date_index, columns)
+    elif mapped or workers or chunk_size:
+        rows, separator = get_sorted_lines(filename, sort_field=date_index,
+                                           keep_datetime_objects=True,
+                                           chunk_size=chunk_size,
+                                           workers=workers, columns=columns,
+                                           date_range=(start, end)
+                                           if start and end else None,
+                                           dialect=dialect, mapped=mapped)
+    else:
+        rows = read_dated_rows(filename, date_index=date_index, columns=columns,
+                               dialect=dialect,
+                               date_range=(start, end) if start and end else None)
+    date_index = column_position(columns, date_index)
+    sample, rows = sample_rows(rows)
+    if not sample:
+        return Aggregator(0, windows), []
+    parsers = guess_column_parsers(sample, date_index, scale)
+    if scale is not None:
+        aggregator = Aggregator(len(parsers), windows,
+                                stats=lambda: fixed_point.Stats(scale))
+    else:
+        aggregator = Aggregator(len(parsers), windows)
+    add = aggregator.add
+    with profiling.stage("aggregating"):
+        for row in rows:
+            add(row[date_index].date(), [parse(row[index]) for index, parse in parsers])
+    indexes = [index for index, parse in parsers]
+    if columns is not None:
+        indexes = [columns[index] for index in indexes]
+    return aggregator, indexes
 
 def runner():
+    profiling.enable_from_arguments()
+    windows = get_option("--windows", type_=lambda value: value.split(","))
+    columns = get_option("--columns",
+                         type_=lambda value: [int(index) for index in value.split(",")])
+    dialect_filename = get_option("--dialect")
+    cache.CACHE_DIR = get_option("--cache-dir", cache.CACHE_DIR)
+    mapped = get_flag("--mmap")
+    scale = get_option("--fixed-point", type_=int)
+    chunk_size = get_option("--sort-chunk-size", type_=int)
+    workers = get_option("--workers", type_=int)
     try:
         pass
     except IndexError:
@@ -60,23 +115,34 @@ def runner():
         start, end = start_end.split(",")
     except (IndexError, ValueError):
         start = end = None
-    dates = parse_mda_file(sys.argv[1], date_index=date_index, start=start, end=end)
-    count = 0
-    values = []
-    for value in list(dates.items())[0][1]:
-        values.append(Decimal(0.0))
-    for date, value in dates.items():
-        if count == 0:
-            print(date)
-        count += 1
-        for index in range(len(values)):
-            values[index] += value[index]
-    else:
-        print(date)
+    aggregator, indexes = aggregate_mda_file(sys.argv[1], date_index=date_index,
+                                             start=start, end=end,
+                                             windows=windows or ("all",),
+                                             columns=columns, mapped=mapped,
+                                             scale=scale,
+                                             chunk_size=chunk_size,
+                                             workers=workers,
+                                             dialect=dialect.get(dialect_filename,
+                                                                 sys.argv[1],
+                                                                 date_index))
+    if windows:
+        for row in aggregator.rows(indexes):
+            print(",".join("" if item is None else str(item) for item in row))
+        return
+    stats = aggregator.results()["all"].get(None, [])
+    if not stats:
+        if start and end:
+            print("No rows with numeric columns between", start, "and", end)
+        else:
+            print("No rows with numeric columns")
+        return
+    count = stats[0].count
+    print(aggregator.first)
+    print(aggregator.last)
     print("A total of %i columns" % count)
-    for value in values:
-        print(value / count, )
-    print(values)
+    for column in stats:
+        print(column.average(), )
+    print([column.total for column in stats])
 
 if __name__ == "__main__":
     runner()
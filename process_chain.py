@@ -1,9 +1,16 @@
 #!/usr/bin/python3
 
 import sys
-from csv_utilities import get_sorted_lines, parse_float, print_csv_lines
-from rates import parse_rate_file, find_best_match
-from utilities import DEBUG_PRINT
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import binary, cache, checkpoint, dialect, fixed_point, profiling
+from csv_utilities import get_sorted_lines, guess_number_format, make_number_parser, parse_float, sample_rows, print_csv_lines, detect_file_format, NUMBER_SAMPLE_SIZE, \
+     dialect_number_format
+from rates import parse_rate_file, parse_composed_rate_files, MAX_GAP
+from table import get_sorted_table
+from utilities import DEBUG_PRINT, get_flag, get_option, store_location
+
+BATCH_SIZE = 1 << 16
 
 def print_syntax_info():
     print()
@@ -17,8 +24,140 @@ def print_syntax_info():
     print()
     print("low_index,high_index can be two fields separated by a comma, or just one field, one number as the example shows.")
     print()
+    print("--max-gap N sets how many days back a rate is looked for, default %i." % MAX_GAP)
+    print()
+    print("--checkpoint FILE saves the converted lines, so the next run only converts lines appended since.")
+    print()
+    print("--mmap reads the rate files memory mapped, through line and date indexes kept in the cache.")
+    print()
+    print("--binary FILE writes the lines as typed binary columns, which mda.py and summarize.py can read, instead of CSV.")
+    print()
+    print("--compose converts through one table composed of all the rate files, adding only the last value.")
+    print()
+    print("--invert 1,3 uses the inverse of the rates of the first and third rate files, such as NOK-USD from USD-NOK.")
+    print()
+    print("--fixed-point 8,2 rounds the amounts to 8 decimals and the values converted to 2, for results that can be reproduced, see fixed_point.py.  It is slower than plain conversion.")
+    print("--rate-scale N sets the decimals rates are rounded to with --fixed-point, default %i." % fixed_point.RATE_SCALE)
+    print()
+    print("Any file can be a source saved with store.py, given as sqlite:PATH#SOURCE.")
+    print()
+    print("--dialect FILE reuses the format of the transaction file saved in FILE, or detects and saves it.")
+    print()
     
+def convert_lines(lines, datetime_index, value_index, rate_tables,
+                  parse=parse_float, batch_size=BATCH_SIZE, fixed=None):
+    """Generator appending the value parsed with parse, and the value
+converted through each rate table in turn, to each line.
+
+Lines are converted batch_size at a time.  For each rate table the whole
+value column of a batch is converted in one merge pass over the sorted
+dates and the table (see RateTable.convert).  With a fixed_point.Chain
+as fixed, the rate tables have fixed-point rates, and the values and
+each conversion of them are rounded to the scales of fixed (see
+fixed_point.Chain.convert)."""
+    lines = iter(lines)
+    while True:
+        batch = list(islice(lines, batch_size))
+        if not batch:
+            return
+        ordinals = [line[datetime_index].toordinal() for line in batch]
+        column = [parse(line[value_index]) for line in batch]
+        columns = [column]
+        with profiling.stage("conversion"):
+            if fixed is not None:
+                columns = fixed.convert(rate_tables, ordinals, column)
+            else:
+                for rates in rate_tables:
+                    column = rates.convert(ordinals, column)
+                    columns.append(column)
+        if profiling.PROFILE is not None:
+            for rates in rate_tables:
+                profiling.PROFILE.count_gaps(rates.gaps(ordinals))
+        for line, values in zip(batch, zip(*columns)):
+            line.extend(values)
+        yield from batch
+
+def convert_table(table, value_index, rate_tables, parse=parse_float,
+                  fixed=None):
+    """Adds the value column parsed with parse, and the value column
+converted through each rate table in turn, to a Table, and returns it.
+See convert_lines for fixed."""
+    ordinals = table.ordinals()
+    column = list(map(parse, table.column(value_index)))
+    with profiling.stage("conversion"):
+        if fixed is not None:
+            for column in fixed.convert(rate_tables, ordinals, column):
+                table.add_column(column)
+        else:
+            table.add_column(column)
+            for rates in rate_tables:
+                column = rates.convert(ordinals, column)
+                table.add_column(column)
+    if profiling.PROFILE is not None:
+        for rates in rate_tables:
+            profiling.PROFILE.count_gaps(rates.gaps(ordinals))
+    return table
+
+def parse_stage(call):
+    """Returns filename, low index, high index and date index of a stage."""
+    try:
+        filename, low_high, date_index = call
+    except ValueError:
+        try:
+            filename, low_high = call
+            date_index = 0
+        except ValueError:
+            print("Error in syntax")
+            print_syntax_info()
+            sys.exit()
+    try:
+        low, high = low_high.split(",")
+    except ValueError:
+        low = high = low_high
+    return filename, int(low), int(high), int(date_index)
+
+def init_worker(cache_dir, profile):
+    cache.set_cache_dir(cache_dir)
+    if profile:
+        profiling.enable()
+
+def load_rate_file(*arguments, **keywords):
+    """Calls parse_rate_file in a worker process, returning the rate table
+and the profile of loading it, if profiling."""
+    if profiling.PROFILE is not None:
+        profiling.enable()
+    return parse_rate_file(*arguments, **keywords), profiling.PROFILE
+
+def load_composed_rate_files(*arguments, **keywords):
+    """Like load_rate_file, for parse_composed_rate_files."""
+    if profiling.PROFILE is not None:
+        profiling.enable()
+    return parse_composed_rate_files(*arguments, **keywords), profiling.PROFILE
+
+def value_parser(number_format, fixed=None):
+    """Returns the parser of the values, in number_format if it is known,
+that of the fixed_point.Chain fixed if given."""
+    if fixed is not None:
+        return fixed.parser(number_format)
+    return make_number_parser(*number_format) if number_format else parse_float
+
+def parse_inverted(value):
+    """Returns the positions of the stages given as 1,3 for --invert."""
+    return {int(stage) - 1 for stage in value.split(",") if stage}
+
 def runner_main():
+    profiling.enable_from_arguments()
+    chunk_size = get_option("--sort-chunk-size", type_=int)
+    workers = get_option("--workers", type_=int)
+    max_gap = get_option("--max-gap", MAX_GAP, type_=int)
+    checkpoint_filename = get_option("--checkpoint")
+    cache.CACHE_DIR = get_option("--cache-dir", cache.CACHE_DIR)
+    dialect_filename = get_option("--dialect")
+    mapped = get_flag("--mmap")
+    compose = get_flag("--compose")
+    inverted = get_option("--invert", set(), type_=parse_inverted)
+    scales = get_option("--fixed-point", type_=fixed_point.parse_scales)
+    rate_scale = get_option("--rate-scale", fixed_point.RATE_SCALE, type_=int)
     calls = [[]]
     for item in sys.argv[1:]:
         if item == "::":
@@ -33,42 +172,145 @@ def runner_main():
     datetime, value = initial_call[1].split(",")
     initial_datetime_index = int(datetime)
     initial_value_index = int(value)
-    initial_lines, separator = get_sorted_lines(initial_call[0],
-                                                keep_datetime_objects=True)
-    for index in range(len(initial_lines)):
-        initial_lines[index].append(
-            parse_float(
-                initial_lines[index][initial_value_index]
-            ))
-
-    for call in calls:
-        try:
-            filename, low_high, date_index = call
-        except ValueError:
-            try:
-                filename, low_high = call
-                date_index = 0
-            except ValueError:
-                print("Error in syntax")
-                print_syntax_info()
-                sys.exit()
+    stages = [parse_stage(call) for call in calls]
+    fixed = None
+    if scales:
+        if compose or inverted:
+            print("Error, --fixed-point can't be used with --compose or --invert")
+            sys.exit(1)
+        fixed = fixed_point.Chain(scales, len(stages), rate_scale)
+    transaction_dialect = dialect.get(dialect_filename, initial_call[0],
+                                      initial_datetime_index)
+
+    # With a checkpoint, only the lines appended since are parsed, as long
+    # as they don't sort before the lines already converted.
+    arguments = (initial_call, stages, max_gap)
+    if compose or inverted:
+        arguments += (compose, sorted(inverted))
+    if fixed is not None:
+        arguments += ("fixed point", fixed.scales, rate_scale)
+    saved = checkpoint.load(checkpoint_filename, initial_call[0], arguments)
+    appended = None
+    if saved is not None:
+        appended = checkpoint.read_appended_rows(initial_call[0], saved,
+                                                 field=initial_datetime_index)
+        last = saved["state"]["last"]
+        if appended and last is not None and \
+           appended[0][initial_datetime_index] < last:
+            appended = None
+
+    # The rate files are loaded in a pool of processes, one per file,
+    # while the transaction file is parsed in this process.
+    rate_tables = []
+    with ProcessPoolExecutor(max_workers=max(len(stages), 1),
+                             initializer=init_worker,
+                             initargs=(cache.CACHE_DIR,
+                                       profiling.PROFILE is not None)) as executor:
+        if compose:
+            futures = [executor.submit(load_composed_rate_files, stages,
+                                       max_gap=max_gap, inverted=inverted,
+                                       mapped=mapped, workers=workers)]
+        else:
+            futures = [executor.submit(load_rate_file, filename, low, high,
+                                       date_index=date_index,
+                                       chunk_size=chunk_size,
+                                       workers=workers,
+                                       max_gap=max_gap, mapped=mapped,
+                                       scale=rate_scale if fixed else None)
+                       for filename, low, high, date_index in stages]
+        # Without chunks, workers or a checkpoint, the lines of a file are
+        # kept in a Table, which takes far less memory than lists of columns.
+        table = None
+        if appended is None and not (chunk_size or workers or checkpoint_filename
+                                     or store_location(initial_call[0])):
+            table, separator = get_sorted_table(initial_call[0],
+                                                sort_field=initial_datetime_index,
+                                                dialect=transaction_dialect)
+        elif appended is None:
+            initial_lines, separator = get_sorted_lines(initial_call[0],
+                                                        sort_field=initial_datetime_index,
+                                                        keep_datetime_objects=True,
+                                                        chunk_size=chunk_size,
+                                                        workers=workers,
+                                                        dialect=transaction_dialect)
+        else:
+            DEBUG_PRINT("Carrying on from checkpoint with", len(appended), "lines")
+            initial_lines, separator = appended, saved["state"]["separator"]
+        for position, future in enumerate(futures):
+            rates, profile = future.result()
+            if position in inverted and not compose:
+                rates = rates.inverted()
+            rate_tables.append(rates)
+            if profile is not None:
+                profiling.PROFILE.merge(profile)
+
+    number_format = dialect_number_format(transaction_dialect, initial_value_index)
+    if table is not None:
+        if number_format is None:
+            sample = table.column(initial_value_index, NUMBER_SAMPLE_SIZE)
+            number_format = guess_number_format(sample)
+        parse = value_parser(number_format, fixed)
+        return convert_table(table, initial_value_index, rate_tables,
+                             parse=parse, fixed=fixed), separator
+    if appended is None and number_format is None:
+        sample, initial_lines = sample_rows(initial_lines)
+        number_format = guess_number_format([line[initial_value_index]
+                                             for line in sample])
+    elif appended is not None:
+        number_format = saved["state"]["number format"]
+    parse = value_parser(number_format, fixed)
+    lines = convert_lines(initial_lines, initial_datetime_index,
+                          initial_value_index, rate_tables, parse=parse,
+                          fixed=fixed)
+    if checkpoint_filename:
+        lines = save_checkpoint(checkpoint_filename, initial_call[0], arguments,
+                                saved if appended is not None else None,
+                                list(lines), separator, number_format, stages,
+                                initial_datetime_index, initial_value_index,
+                                rate_tables, parse, transaction_dialect, fixed)
+    elif not chunk_size:
+        lines = list(lines)
+    return lines, separator
+
+def save_checkpoint(checkpoint_filename, filename, arguments, saved, lines,
+                    separator, number_format, stages, datetime_index,
+                    value_index, rate_tables, parse, dialect=None, fixed=None):
+    """Saves a checkpoint with all the converted lines so far, and returns
+them.  The lines from the previous checkpoint are converted again if any
+of the rate files has changed since."""
+    rate_files = [cache.file_identity(stage[0]) for stage in stages]
+    if saved is not None:
+        previous = saved["state"]["lines"]
+        if saved["state"]["rate files"] != rate_files:
+            DEBUG_PRINT("Rate files changed, converting all lines again")
+            added = len(rate_tables) + 1
+            previous = list(convert_lines([line[:-added] for line in previous],
+                                          datetime_index, value_index,
+                                          rate_tables, parse=parse,
+                                          fixed=fixed))
+        lines = previous + lines
+        file_format = saved["format"]
+    else:
         try:
-            low, high = low_high.split(",")
+            file_format = detect_file_format(filename, datetime_index,
+                                             dialect=dialect)
         except ValueError:
-            low = high = low_high
-        low, high, date_index = int(low), int(high), int(date_index)
-        rates = parse_rate_file(filename, low, high, date_index=date_index)
-        for index in range(len(initial_lines)):
-            date = initial_lines[index][initial_datetime_index]
-            rate = find_best_match(rates, date.date())
-            new_value = initial_lines[index][-1] * rate
-            initial_lines[index].append(new_value)
-    return initial_lines, separator
+            DEBUG_PRINT("Datetime format not settled, no checkpoint saved")
+            return lines
+    state = {"lines": lines, "separator": separator,
+             "number format": number_format, "rate files": rate_files,
+             "last": lines[-1][datetime_index] if lines else None}
+    checkpoint.save(checkpoint_filename, filename, arguments, file_format, state)
+    return lines
 
 def runner(string_type=type("")):
+    binary_filename = get_option("--binary")
     lines, separator = runner_main()
-    DEBUG_PRINT(lines[0])
-    print_csv_lines(lines, separator)
+    if binary_filename:
+        with profiling.stage("rendering"):
+            binary.write(binary_filename, lines, separator)
+    else:
+        print_csv_lines(lines, separator)
     
 if __name__ == "__main__":
     runner()
@@ -0,0 +1,100 @@
+"""Stage timers and counters, written as a JSON report with --profile FILE.
+
+Profiling is off unless enable is called.  When it is off, stage returns
+a shared do-nothing context manager and count returns straight away, and
+nothing is done per row: stages time whole loops, and counts are added
+from the size of what a stage produced.  Rate lookup gaps are only worked
+out when profiling is on."""
+
+import atexit, json, time
+
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+from utilities import get_option
+
+PROFILE = None
+NULL_STAGE = nullcontext()
+
+class Profile:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.counters = Counter()
+        self.gaps = Counter()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            stage = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0})
+            stage["seconds"] += seconds
+            stage["calls"] += 1
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def count_gaps(self, gaps):
+        self.gaps.update(gaps)
+
+    def merge(self, other):
+        """Adds the stages and counts of another profile, such as that of
+a worker process."""
+        for name, other_stage in other.stages.items():
+            stage = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0})
+            stage["seconds"] += other_stage["seconds"]
+            stage["calls"] += other_stage["calls"]
+        self.counters.update(other.counters)
+        self.gaps.update(other.gaps)
+
+    def report(self):
+        hits = self.counters["cache hits"]
+        misses = self.counters["cache misses"]
+        lookups = sum(self.gaps.values())
+        return {
+            "seconds": time.perf_counter() - self.started,
+            "stages": self.stages,
+            "counters": dict(self.counters),
+            "cache": {"hits": hits, "misses": misses,
+                      "hit rate": hits / (hits + misses) if hits + misses else None},
+            "rate gaps": {
+                "lookups": lookups,
+                "exact": self.gaps[0],
+                "mean": (sum(gap * count for gap, count in self.gaps.items()) /
+                         lookups if lookups else None),
+                "max": max(self.gaps) if self.gaps else None,
+                "histogram": {str(gap): self.gaps[gap] for gap in sorted(self.gaps)},
+            },
+        }
+
+    def write(self, filename):
+        with open(filename, "w") as file:
+            json.dump(self.report(), file, indent=1)
+
+def enable(filename=None):
+    """Turns profiling on, writing the report to filename at exit."""
+    global PROFILE
+    PROFILE = Profile()
+    if filename:
+        atexit.register(PROFILE.write, filename)
+    return PROFILE
+
+def enable_from_arguments():
+    """Turns profiling on if --profile FILE is on the command line."""
+    filename = get_option("--profile")
+    if filename:
+        enable(filename)
+
+def stage(name):
+    """Returns a context manager timing a stage."""
+    if PROFILE is None:
+        return NULL_STAGE
+    return PROFILE.stage(name)
+
+def count(name, amount=1):
+    """Adds amount to a counter, such as rows or bytes read."""
+    if PROFILE is not None:
+        PROFILE.count(name, amount)
@@ -1,39 +1,417 @@
 #!/usr/bin/python3
 
-import csv, sys
+import copy, sys
 
+from array import array
+from bisect import bisect_right
 from decimal import Decimal
-from collections import OrderedDict
 from datetime import date as Date
-from datetime import timedelta
 
-from csv_utilities import get_sorted_lines, parse_float
-from utilities import DEBUG_PRINT
+import cache, fixed_point, profiling
+from csv_utilities import get_sorted_lines, guess_number_parser, sample_rows, \
+     write_csv_lines, guess_number_format
+from table import get_sorted_table
+from utilities import get_flag, get_option, store_location
 
-def parse_rate_file(filename, low, high, date_index=0):
-    rates = OrderedDict()
-    lines, separator = get_sorted_lines(filename, sort_field=date_index,
-                                        keep_datetime_objects=True)
+MAX_GAP = 10
+ONE = Decimal(1)
+
+class RateTable:
+    """Rates sorted by date, with the dates kept as ordinals in an array
+parallel to the list of rates.
+
+A lookup returns the rate on a date, or on the closest prior date no more
+than max_gap days earlier.  Lookups are done with bisect, and the table
+can be read like a (date -> rate) mapping."""
+
+    def __init__(self, max_gap=MAX_GAP):
+        self.ordinals = array("l")
+        self.rates = []
+        self.max_gap = max_gap
+
+    def append(self, date, rate):
+        """Adds the rate for a date, which can't be before the last date
+added.  A rate for the same date as the last one replaces it."""
+        self.append_ordinal(date.toordinal(), rate)
+
+    def append_ordinal(self, ordinal, rate):
+        """Like append, for a date ordinal."""
+        if self.ordinals and ordinal <= self.ordinals[-1]:
+            if ordinal < self.ordinals[-1]:
+                raise ValueError("Rates must be added in date order",
+                                 Date.fromordinal(ordinal))
+            self.rates[-1] = rate
+            return
+        self.ordinals.append(ordinal)
+        self.rates.append(rate)
+
+    def find_index(self, ordinal, low=0):
+        """Returns the index of the rate to use for a date ordinal, searching
+from index low."""
+        index = bisect_right(self.ordinals, ordinal, low) - 1
+        if index < 0 or ordinal - self.ordinals[index] > self.max_gap:
+            raise ValueError("Invalid rates/date", Date.fromordinal(ordinal),
+                             self.max_gap)
+        return index
+
+    def lookup(self, date):
+        """Returns the rate on date, or on the first available prior date."""
+        return self.rates[self.find_index(date.toordinal())]
+
+    def lookup_many(self, dates):
+        """Returns a list of rates for an ascending sequence of dates."""
+        rates = self.rates
+        find_index = self.find_index
+        index = 0
+        matches = []
+        for date in dates:
+            index = find_index(date.toordinal(), index)
+            matches.append(rates[index])
+        return matches
+
+    def convert(self, ordinals, values):
+        """Returns a list of values multiplied by the rate for the date
+ordinal next to each value.
+
+The ordinals are expected to be ascending, so the dates and the table are
+walked together in one merge pass; if an ordinal goes backwards, the
+position in the table is found again with bisect."""
+        table = self.ordinals
+        rates = self.rates
+        max_gap = self.max_gap
+        last = len(table) - 1
+        index = -1
+        previous = None
+        converted = []
+        for ordinal, value in zip(ordinals, values):
+            if previous is not None and ordinal < previous:
+                index = bisect_right(table, ordinal) - 1
+            previous = ordinal
+            while index < last and table[index + 1] <= ordinal:
+                index += 1
+            if index < 0 or ordinal - table[index] > max_gap:
+                raise ValueError("Invalid rates/date", Date.fromordinal(ordinal),
+                                 max_gap)
+            converted.append(value * rates[index])
+        return converted
+
+    def dump(self):
+        """Returns the table as plain bytes, for caching."""
+        rates = "\n".join(map(str, self.rates)).encode("ascii")
+        return self.ordinals.tobytes(), rates, self.max_gap
+
+    @classmethod
+    def load(cls, state):
+        """Returns a table from what dump returned."""
+        ordinals, rates, max_gap = state
+        table = cls(max_gap=max_gap)
+        table.ordinals.frombytes(ordinals)
+        if rates:
+            table.rates = list(map(Decimal, rates.decode("ascii").split("\n")))
+        return table
+
+    def expiry(self, index):
+        """Returns the last date ordinal the rate at index can be used for."""
+        return self.ordinals[index] + self.max_gap
+
+    def inverted(self):
+        """Returns a table with the inverse of each rate, such as NOK-USD
+from USD-NOK."""
+        table = copy.copy(self)
+        table.rates = [ONE / rate for rate in self.rates]
+        return table
+
+    def gaps(self, ordinals):
+        """Returns how many days back the rate for each date ordinal is
+found, for profiling."""
+        table = self.ordinals
+        return [ordinal - table[bisect_right(table, ordinal) - 1]
+                for ordinal in ordinals]
+
+    def __len__(self):
+        return len(self.rates)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, date):
+        try:
+            self[date]
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, date):
+        ordinal = date.toordinal()
+        index = bisect_right(self.ordinals, ordinal) - 1
+        if index < 0 or self.ordinals[index] != ordinal:
+            raise KeyError(date)
+        return self.rates[index]
+
+    def keys(self):
+        return list(map(Date.fromordinal, self.ordinals))
+
+    def values(self):
+        return list(self.rates)
+
+    def items(self):
+        return list(zip(self.keys(), self.values()))
+
+class ComposedRateTable(RateTable):
+    """A RateTable where each rate can be used up to its own last date
+ordinal, kept in an array parallel to the rates, instead of for max_gap
+days.  See compose."""
+
+    def __init__(self, max_gap=MAX_GAP):
+        super().__init__(max_gap=max_gap)
+        self.expiries = array("l")
+
+    def append_ordinal(self, ordinal, rate, expiry=None):
+        """Adds the rate for a date ordinal, after the last one added,
+which can be used up to the ordinal expiry (max_gap days by default)."""
+        if self.ordinals and ordinal <= self.ordinals[-1]:
+            raise ValueError("Rates must be added in date order",
+                             Date.fromordinal(ordinal))
+        self.ordinals.append(ordinal)
+        self.rates.append(rate)
+        self.expiries.append(ordinal + self.max_gap if expiry is None else expiry)
+
+    def expiry(self, index):
+        return self.expiries[index]
+
+    def find_index(self, ordinal, low=0):
+        index = bisect_right(self.ordinals, ordinal, low) - 1
+        if index < 0 or ordinal > self.expiries[index]:
+            raise ValueError("Invalid rates/date", Date.fromordinal(ordinal),
+                             self.max_gap)
+        return index
+
+    def convert(self, ordinals, values):
+        """Like RateTable.convert, checking the expiry of each rate."""
+        table = self.ordinals
+        rates = self.rates
+        expiries = self.expiries
+        last = len(table) - 1
+        index = -1
+        previous = None
+        converted = []
+        for ordinal, value in zip(ordinals, values):
+            if previous is not None and ordinal < previous:
+                index = bisect_right(table, ordinal) - 1
+            previous = ordinal
+            while index < last and table[index + 1] <= ordinal:
+                index += 1
+            if index < 0 or ordinal > expiries[index]:
+                raise ValueError("Invalid rates/date", Date.fromordinal(ordinal),
+                                 self.max_gap)
+            converted.append(value * rates[index])
+        return converted
+
+    def usable(self):
+        """Returns the indexes of the rates, leaving out the dates there is
+no usable rate on."""
+        return [index for index, (ordinal, expiry) in
+                enumerate(zip(self.ordinals, self.expiries)) if expiry >= ordinal]
+
+    def __getitem__(self, date):
+        ordinal = date.toordinal()
+        index = bisect_right(self.ordinals, ordinal) - 1
+        if index < 0 or self.ordinals[index] != ordinal or \
+           self.expiries[index] < ordinal:
+            raise KeyError(date)
+        return self.rates[index]
+
+    def keys(self):
+        return [Date.fromordinal(self.ordinals[index]) for index in self.usable()]
+
+    def values(self):
+        return [self.rates[index] for index in self.usable()]
+
+    def dump(self):
+        return super().dump() + (self.expiries.tobytes(),)
+
+    @classmethod
+    def load(cls, state):
+        table = super().load(state[:-1])
+        table.expiries.frombytes(state[-1])
+        return table
+
+def compose(tables):
+    """Returns a ComposedRateTable converting through each of tables in
+turn, with one rate for each date any of them has a rate on.
+
+On such a date the rate is the product of the rate each table would use
+then, and it can be used until one of those can't or the next date.  So
+converting with the composed table gives the same rates, and fails on
+the same dates, as converting through the tables one after another.  A
+date some table has no usable rate for is added with an expiry before the
+date, so lookups from it fail as they would."""
+    ordinals = sorted(set().union(*(table.ordinals for table in tables)))
+    composed = ComposedRateTable()
+    indexes = [-1] * len(tables)
+    for ordinal in ordinals:
+        rate = ONE
+        expiry = None
+        for position, table in enumerate(tables):
+            table_ordinals = table.ordinals
+            index = indexes[position]
+            while index + 1 < len(table_ordinals) and table_ordinals[index + 1] <= ordinal:
+                index += 1
+            indexes[position] = index
+            if index < 0:
+                expiry = ordinal - 1
+                break
+            rate *= table.rates[index]
+            if expiry is None or table.expiry(index) < expiry:
+                expiry = table.expiry(index)
+        if expiry < ordinal:
+            if not composed:
+                continue
+            rate = ONE
+        composed.append_ordinal(ordinal, rate, expiry)
+    return composed
+
+def parse_composed_rate_files(stages, max_gap=MAX_GAP, inverted=(), mapped=False,
+                              workers=None):
+    """Returns the composed table (see compose) of the rate files of
+stages, each (filename, low, high, date_index) as for parse_rate_file,
+with the rates of the stages at the positions in inverted inverted.
+
+It is cached with the first rate file, and the identity of every file in
+its specification, so it is made again when any of them changes."""
+    inverted = tuple(sorted(inverted))
+    def compose_files():
+        tables = []
+        for position, (filename, low, high, date_index) in enumerate(stages):
+            rates = parse_rate_file(filename, low, high, date_index=date_index,
+                                    workers=workers, max_gap=max_gap,
+                                    mapped=mapped)
+            tables.append(rates.inverted() if position in inverted else rates)
+        with profiling.stage("composing"):
+            return compose(tables)
+    spec = ("composed rates", max_gap, inverted,
+            tuple((cache.file_identity(filename), int(low), int(high), date_index)
+                  for filename, low, high, date_index in stages))
+    return cache.cached(stages[0][0], spec, compose_files,
+                        encode=ComposedRateTable.dump,
+                        decode=ComposedRateTable.load)
+
+def write_rate_file(rates, filename):
+    """Writes a table as a date,rate CSV file, which can be read as a rate
+file with the column 1 as low and high.  Read back, the rates of a
+composed table are used for max_gap days, not up to their expiry."""
+    def rows():
+        yield ("date", "rate")
+        for date, rate in rates.items():
+            yield date.isoformat(), rate
+    with open(filename, "w") as file:
+        write_csv_lines(rows(), ",", file=file)
+
+def parse_rate_file(filename, low, high, date_index=0, chunk_size=None,
+                    workers=None, max_gap=MAX_GAP, mapped=False, scale=None):
+    """Returns a RateTable with the average of the low and high columns,
+from the cache if possible.  A source in a store (see store.py) has the
+averages already, and is read from there.  With a scale, the rates are
+rounded to it (see fixed_point.py)."""
+    location = store_location(filename)
+    if location is not None:
+        # Imported here, as store is built on this module
+        from store import read_rate_table
+        return read_rate_table(location, max_gap=max_gap, scale=scale)
+    spec = ("rates", int(low), int(high), date_index)
+    if scale is not None:
+        spec += ("rounded", scale)
+    rates = cache.cached(filename, spec,
+                         lambda: read_rate_file(filename, low, high,
+                                                date_index=date_index,
+                                                chunk_size=chunk_size,
+                                                workers=workers,
+                                                mapped=mapped, scale=scale),
+                         encode=RateTable.dump, decode=RateTable.load)
+    rates.max_gap = max_gap
+    return rates
+
+def read_rate_file(filename, low, high, date_index=0, chunk_size=None,
+                   workers=None, mapped=False, scale=None):
+    """Returns a RateTable with the average of the low and high columns.
+The file is read into a Table, unless it is memory mapped, or sorted in
+chunks or by workers."""
+    rates = RateTable()
     low_index = int(low)
     high_index = int(high)
-    for line in lines:
-        date = line[date_index].date()
-        low_ = parse_float(line[low_index])
-        high_ = parse_float(line[high_index])
-        rates[date] = ((low_ + high_) / 2)
+    if mapped or chunk_size or workers:
+        lines, separator = get_sorted_lines(filename, sort_field=date_index,
+                                            keep_datetime_objects=True,
+                                            chunk_size=chunk_size,
+                                            workers=workers, mapped=mapped,
+                                            columns=[date_index, low_index,
+                                                     high_index])
+        columns = ((line[0].toordinal(), line[1], line[2]) for line in lines)
+    else:
+        table, separator = get_sorted_table(filename, sort_field=date_index)
+        columns = zip(table.ordinals(), table.column(low_index),
+                      table.column(high_index))
+    sample, columns = sample_rows(columns)
+    if scale is not None:
+        parse_low = fixed_point.make_decimal_parser(
+            scale, guess_number_format([low_ for ordinal, low_, high_ in sample]))
+        parse_high = fixed_point.make_decimal_parser(
+            scale, guess_number_format([high_ for ordinal, low_, high_ in sample]))
+        midpoint = fixed_point.midpoint
+        with profiling.stage("rate table"):
+            for ordinal, low_, high_ in columns:
+                rates.append_ordinal(ordinal, midpoint(parse_low(low_),
+                                                       parse_high(high_), scale))
+        return rates
+    parse_low = guess_number_parser([low_ for ordinal, low_, high_ in sample])
+    parse_high = guess_number_parser([high_ for ordinal, low_, high_ in sample])
+    with profiling.stage("rate table"):
+        for ordinal, low_, high_ in columns:
+            rates.append_ordinal(ordinal, (parse_low(low_) + parse_high(high_)) / 2)
     return rates
 
-def find_best_match(rates, date, offset=0):
-    """Returns the rate for the matching day, or the first available prior date."""
-    DEBUG_PRINT(date, offset)
-    if offset < -10:
-        raise ValueError("Invalid rates/date", date, offset)
-    try:
-        return rates[date - timedelta(days=offset)]
-    except KeyError:
-        return find_best_match(rates, date, offset - 1)
+def find_best_match(rates, date):
+    """Returns the rate for the matching day, or the first available prior date.
+Not used here, kept for library use; see RateTable.lookup."""
+    return rates.lookup(date)
+
+def compose_runner(max_gap=MAX_GAP, mapped=False):
+    """Composes the rate files given as stages of process_chain.py, such
+as EUR-NOK.csv -1 -2 :: USD-NOK.csv -1 -2 --invert 2 for EUR-USD, and
+writes the composed rates with --output FILE."""
+    inverted = {int(stage) - 1 for stage in get_option("--invert", "").split(",")
+                if stage}
+    output = get_option("--output")
+    calls = [[]]
+    for item in sys.argv[1:]:
+        if item == "::":
+            calls.append([])
+        else:
+            calls[-1].append(item)
+    stages = []
+    for call in calls:
+        low, _, high = call[1].partition(",")
+        date_index = int(call[2]) if len(call) > 2 else 0
+        stages.append((call[0], int(low), int(high or low), date_index))
+    rates = parse_composed_rate_files(stages, max_gap=max_gap, inverted=inverted,
+                                      mapped=mapped)
+    if output:
+        write_rate_file(rates, output)
+    return rates
 
 def runner():
+    profiling.enable_from_arguments()
+    chunk_size = get_option("--sort-chunk-size", type_=int)
+    workers = get_option("--workers", type_=int)
+    max_gap = get_option("--max-gap", MAX_GAP, type_=int)
+    cache.CACHE_DIR = get_option("--cache-dir", cache.CACHE_DIR)
+    mapped = get_flag("--mmap")
+    on = get_option("--on")
+    if "::" in sys.argv:
+        rates = compose_runner(max_gap=max_gap, mapped=mapped)
+        keys = tuple(rates.keys())
+        print(keys[0], rates[keys[0]], keys[-1], rates[keys[-1]], len(rates))
+        return
     try:
         low_high = sys.argv[2]
     except IndexError:
@@ -41,7 +419,18 @@ def runner():
         print()
         print("For example,", sys.argv[0], sys.argv[1], "3,2")
         print("low, high and date index supports python-style indexing, for example 0 or -1")
+        print()
+        print("Rate files can be composed as in process_chain.py, for example EUR-USD with")
+        print(sys.argv[0], "EUR-NOK.csv -1 -2 :: USD-NOK.csv -1 -2 --invert 2 --output EUR-USD.csv")
+        print()
+        print("--on DATE prints the rate on a date, which for a sqlite:PATH#SOURCE store is one query")
         sys.exit(1)
+    if on and store_location(sys.argv[1]):
+        # Imported here, as store is built on this module
+        from store import lookup_rate
+        print(on, lookup_rate(store_location(sys.argv[1]), Date.fromisoformat(on),
+                              max_gap=max_gap))
+        return
     try:
         date_index = int(sys.argv[3])
     except IndexError:
@@ -51,7 +440,12 @@ def runner():
     low, high = low_high.split(",")
     low = int(low)
     high = int(high)
-    rates = parse_rate_file(sys.argv[1], low, high, date_index=date_index)
+    rates = parse_rate_file(sys.argv[1], low, high, date_index=date_index,
+                            chunk_size=chunk_size,
+                            workers=workers, max_gap=max_gap, mapped=mapped)
+    if on:
+        print(on, rates.lookup(Date.fromisoformat(on)))
+        return
     keys = tuple(rates.keys())
     print(keys[0], rates[keys[0]], keys[-1], rates[keys[-1]], len(rates))
 
@@ -0,0 +1,263 @@
+#!/usr/bin/python3
+
+"""Conversion service keeping parsed rate tables in memory.
+
+./server.py [--port 8421] [--host 127.0.0.1] [--socket PATH] [--root DIR]
+            [--max-gap N] [--cache-dir DIR] [--mmap] [--profile FILE]
+
+Serves a JSON API over HTTP, on a TCP port or on a Unix socket with
+--socket PATH, so a program can convert amounts without starting
+process_chain.py and parsing the same rate files for every call.
+
+POST /convert with {"chain": [[filename, "low,high", date_index], ...],
+"rows": [[date, amount], ...]} converts each amount through the rate
+files in turn, as the stages of process_chain.py do; date_index can be
+left out.  Filenames are relative to the --root directory (the current
+directory by default), and files outside it, after following symbolic
+links, are refused with status 403, as are stores (sqlite:PATH#SOURCE)
+outside it.  Dates are ISO dates, anything after the first 10 characters
+(such as a time) is ignored, and amounts are numbers or strings.  The
+answer is {"rows": [[amount, converted, ...], ...]}, with the converted
+values as strings, or {"error": ...} with status 400.
+
+GET /stats returns the rate tables loaded and the latency of recent
+requests.
+
+Rate tables are loaded with rates.parse_rate_file the first time they
+are used, so the on-disk cache is used if it is on, and kept.  A table is
+loaded again when its file changes (see cache.file_identity), which is
+checked on each request.  Requests are handled in threads, and share the
+tables, which aren't changed once loaded."""
+
+import json, os, signal, socketserver, stat, sys, threading, time
+
+from collections import deque
+from datetime import date as Date
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cache, profiling
+from csv_utilities import parse_float
+from rates import parse_rate_file, MAX_GAP
+from utilities import DEBUG_PRINT, get_flag, get_option, store_location, \
+     STORE_PREFIX
+
+PORT = 8421
+LATENCY_SAMPLES = 10000
+
+class RateTables:
+    """Rate tables by file and columns, loaded again when the file changes.
+Only files within root are read."""
+
+    def __init__(self, max_gap=MAX_GAP, mapped=False, root="."):
+        self.max_gap = max_gap
+        self.mapped = mapped
+        self.root = os.path.realpath(root)
+        self.tables = {}
+        self.loading = {}
+        self.lock = threading.Lock()
+
+    def resolve(self, filename):
+        """Returns the real path of a file, or store, given relative to
+root.  Raises PermissionError if it is outside root."""
+        location = store_location(filename)
+        path = os.path.realpath(os.path.join(self.root,
+                                             location[0] if location else filename))
+        if os.path.commonpath([path, self.root]) != self.root:
+            raise PermissionError("Outside the served directory", filename)
+        if location:
+            return STORE_PREFIX + path + "#" + location[1]
+        return path
+
+    def get(self, filename, low, high, date_index=0):
+        filename = self.resolve(filename)
+        key = (filename, low, high, date_index)
+        identity = cache.file_identity(filename)
+        entry = self.tables.get(key)
+        if entry is not None and entry[0] == identity:
+            return entry[1]
+        # One thread loads a table, others asking for it wait for it
+        with self.lock:
+            loading = self.loading.setdefault(key, threading.Lock())
+        with loading:
+            entry = self.tables.get(key)
+            if entry is not None and entry[0] == identity:
+                return entry[1]
+            DEBUG_PRINT("Loading", filename, low, high, date_index)
+            rates = parse_rate_file(filename, low, high, date_index=date_index,
+                                    max_gap=self.max_gap, mapped=self.mapped)
+            self.tables[key] = identity, rates
+            return rates
+
+    def describe(self):
+        return [{"filename": key[0], "low": key[1], "high": key[2],
+                 "date index": key[3], "rates": len(rates),
+                 "first": str(Date.fromordinal(rates.ordinals[0])) if len(rates) else None,
+                 "last": str(Date.fromordinal(rates.ordinals[-1])) if len(rates) else None}
+                for key, (identity, rates) in list(self.tables.items())]
+
+def parse_stage(stage):
+    """Returns filename, low index, high index and date index of a stage,
+given as in process_chain.py."""
+    if not 2 <= len(stage) <= 3:
+        raise ValueError("A stage is [filename, low,high, date_index]", stage)
+    filename, low_high = str(stage[0]), str(stage[1])
+    date_index = int(stage[2]) if len(stage) == 3 else 0
+    try:
+        low, high = low_high.split(",")
+    except ValueError:
+        low = high = low_high
+    return filename, int(low), int(high), date_index
+
+def parse_amount(value):
+    if isinstance(value, str):
+        return parse_float(value)
+    return Decimal(str(value))
+
+def convert(tables, chain, rows):
+    """Returns each (date, amount) row of rows as the amount and the
+amount converted through each rate table of chain in turn."""
+    stages = [tables.get(*parse_stage(stage)) for stage in chain]
+    ordinals = [Date.fromisoformat(str(row[0])[:10]).toordinal() for row in rows]
+    column = [parse_amount(row[1]) for row in rows]
+    columns = [column]
+    for rates in stages:
+        column = rates.convert(ordinals, column)
+        columns.append(column)
+    return [list(map(str, values)) for values in zip(*columns)]
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def send_json(self, status, value):
+        body = json.dumps(value).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/stats":
+            self.send_json(404, {"error": "Not found"})
+            return
+        latencies = list(self.server.latencies)
+        self.send_json(200, {
+            "requests": self.server.requests,
+            "latency ms": {"p50": percentile(latencies, 0.5),
+                           "p99": percentile(latencies, 0.99),
+                           "max": max(latencies) if latencies else None},
+            "rate tables": self.server.tables.describe()})
+
+    def do_POST(self):
+        start = time.perf_counter()
+        if self.path != "/convert":
+            self.send_json(404, {"error": "Not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length).decode("utf-8"))
+            with profiling.stage("converting"):
+                rows = convert(self.server.tables, request["chain"], request["rows"])
+        except (ValueError, KeyError, TypeError, IndexError, OSError,
+                ArithmeticError) as error:
+            DEBUG_PRINT("Bad request", repr(error))
+            status = 403 if isinstance(error, PermissionError) else 400
+            self.send_json(status, {"error": " ".join(map(str, error.args)) or repr(error)})
+            return
+        self.send_json(200, {"rows": rows})
+        self.server.record((time.perf_counter() - start) * 1000)
+
+    def log_message(self, format, *arguments):
+        DEBUG_PRINT(format % arguments)
+
+class Service:
+    """What the handlers share, mixed into the server classes."""
+    daemon_threads = True
+
+    def setup_service(self, tables):
+        self.tables = tables
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def record(self, milliseconds):
+        with self.lock:
+            self.latencies.append(milliseconds)
+            self.requests += 1
+
+class TCPServer(Service, ThreadingHTTPServer):
+    pass
+
+class UnixServer(Service, socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    pass
+
+class UnixHandler(Handler):
+    def address_string(self):
+        return "unix"
+
+    def setup(self):
+        # Unix sockets have no client address, which the handler expects
+        self.client_address = ("unix", 0)
+        super().setup()
+
+def is_socket(path):
+    try:
+        return stat.S_ISSOCK(os.stat(path).st_mode)
+    except FileNotFoundError:
+        return False
+
+def make_server(tables, host="127.0.0.1", port=PORT, socket_path=None):
+    """Returns a server on a Unix socket at socket_path, replacing a socket
+left there, or else on host and port.  Raises FileExistsError if
+something other than a socket is at socket_path."""
+    if socket_path:
+        if is_socket(socket_path):
+            os.remove(socket_path)
+        elif os.path.lexists(socket_path):
+            raise FileExistsError("Not a socket", socket_path)
+        server = UnixServer(socket_path, UnixHandler)
+    else:
+        server = TCPServer((host, port), Handler)
+    server.setup_service(tables)
+    return server
+
+def runner():
+    profiling.enable_from_arguments()
+    host = get_option("--host", "127.0.0.1")
+    port = get_option("--port", PORT, type_=int)
+    socket_path = get_option("--socket")
+    root = get_option("--root", ".")
+    max_gap = get_option("--max-gap", MAX_GAP, type_=int)
+    cache.CACHE_DIR = get_option("--cache-dir", cache.CACHE_DIR)
+    mapped = get_flag("--mmap")
+    if len(sys.argv) > 1:
+        print("Error, use:", sys.argv[0], "[--port %i] [--host 127.0.0.1]" % PORT,
+              "[--socket PATH] [--root DIR] [--max-gap N] [--cache-dir DIR]",
+              "[--mmap] [--profile FILE]")
+        sys.exit(1)
+    try:
+        server = make_server(RateTables(max_gap, mapped, root), host, port,
+                             socket_path)
+    except FileExistsError as error:
+        print("Error:", *error.args, file=sys.stderr)
+        sys.exit(1)
+    signal.signal(signal.SIGTERM, lambda *arguments: sys.exit())
+    print("Serving on", socket_path or "%s:%i" % (host, port), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        if socket_path and is_socket(socket_path):
+            os.remove(socket_path)
+
+if __name__ == "__main__":
+    runner()
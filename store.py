@@ -0,0 +1,255 @@
+#!/usr/bin/python3
+
+"""A local SQLite store for transactions and rate series.
+
+./store.py <database> import <source> <CSV file> [date_index] [--dialect FILE]
+./store.py <database> import-rates <source> <CSV file> <low,high> [date_index]
+./store.py <database> list
+
+import reads a transaction file with csv_utilities.get_sorted_lines, so
+its format is detected as usual, and saves its rows under a source name,
+replacing any rows saved under it before.  import-rates saves the rates
+of a rate file, the average of the low and high columns as read by
+rates.parse_rate_file.
+
+The tools read a source given as sqlite:PATH#SOURCE instead of a file,
+such as ./summarize.py sqlite:taxes.db#wallet1 0 1 2023-07-01,2023-09-30.
+Transactions are kept with the sort datetime of each row as an int (see
+utilities.datetime_to_key) and rates by date ordinal, both in the
+primary key after the source, so date ranges are read with indexed
+queries instead of parsing and filtering a file, and a single rate
+(lookup_rate, or rates.py --on DATE) is one query.
+
+Rows are kept as JSON lists of their text columns.  Like binary column
+files, datetimes read with keep_datetime_objects false are formatted as
+by str."""
+
+import json, os, sqlite3, sys
+
+from contextlib import closing
+from decimal import Decimal
+from urllib.request import pathname2url
+
+import dialect, fixed_point, profiling
+from csv_utilities import get_sorted_lines, column_picker, column_position
+from rates import RateTable, parse_rate_file, MAX_GAP
+from utilities import datetime_to_key, key_to_datetime, get_option, STORE_PREFIX
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    name TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    separator TEXT NOT NULL,
+    columns INTEGER NOT NULL,
+    date_index INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS transactions (
+    source TEXT NOT NULL,
+    key INTEGER NOT NULL,
+    line INTEGER NOT NULL,
+    row TEXT NOT NULL,
+    PRIMARY KEY (source, key, line)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rates (
+    source TEXT NOT NULL,
+    ordinal INTEGER NOT NULL,
+    rate TEXT NOT NULL,
+    PRIMARY KEY (source, ordinal)
+) WITHOUT ROWID;
+"""
+
+def connect(path, create=False):
+    """Returns a connection to a database, created with the schema if
+create is true, otherwise opened read only."""
+    if create:
+        connection = sqlite3.connect(path)
+        connection.executescript(SCHEMA)
+        return connection
+    if not os.path.exists(path):
+        raise FileNotFoundError("No such database", path)
+    return sqlite3.connect("file:%s?mode=ro" % pathname2url(os.path.abspath(path)),
+                           uri=True)
+
+def get_source(connection, source, kind):
+    """Returns the separator, column count and date index of a source."""
+    found = connection.execute("SELECT kind, separator, columns, date_index "
+                               "FROM sources WHERE name = ?", (source,)).fetchone()
+    if found is None:
+        raise ValueError("No such source", source)
+    if found[0] != kind:
+        raise ValueError("Source holds %s, not %s" % (found[0], kind), source)
+    return found[1:]
+
+def replace_source(connection, source, kind, filename, separator, columns,
+                   date_index):
+    connection.execute("DELETE FROM transactions WHERE source = ?", (source,))
+    connection.execute("DELETE FROM rates WHERE source = ?", (source,))
+    connection.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, ?, ?)",
+                       (source, kind, os.path.abspath(filename), separator,
+                        columns, date_index))
+
+def import_transactions(path, source, filename, date_index=0, dialect=None):
+    """Saves the rows of a transaction file under source, and returns how
+many there are."""
+    rows, separator = get_sorted_lines(filename, sort_field=date_index,
+                                       keep_datetime_objects=True,
+                                       dialect=dialect)
+    columns = len(rows[0]) if rows else 0
+    date_index = date_index % columns if columns else 0
+    def records():
+        for line, row in enumerate(rows):
+            key = datetime_to_key(row[date_index])
+            row[date_index] = None
+            yield source, key, line, json.dumps(row)
+    with profiling.stage("storing"), closing(connect(path, create=True)) as connection, \
+         connection:
+        replace_source(connection, source, "transactions", filename, separator,
+                       columns, date_index)
+        connection.executemany("INSERT INTO transactions VALUES (?, ?, ?, ?)",
+                               records())
+    return len(rows)
+
+def import_rates(path, source, filename, low, high, date_index=0):
+    """Saves the rates of a rate file under source, and returns how many
+there are."""
+    rates = parse_rate_file(filename, low, high, date_index=date_index)
+    with profiling.stage("storing"), closing(connect(path, create=True)) as connection, \
+         connection:
+        replace_source(connection, source, "rates", filename, ",", 2, 0)
+        connection.executemany("INSERT INTO rates VALUES (?, ?, ?)",
+                               ((source, ordinal, str(rate)) for ordinal, rate
+                                in zip(rates.ordinals, rates.rates)))
+    return len(rates)
+
+def key_range(datetime_range):
+    """Returns the SQL condition and parameters for a datetime range."""
+    if not datetime_range:
+        return "", ()
+    return " AND key >= ? AND key < ?", tuple(map(datetime_to_key, datetime_range))
+
+def read_dated_rows(location, date_index=0, columns=None, datetime_range=None):
+    """Generator yielding the rows of a source in date order, with the
+datetime in date_index, which must be the field the source was imported
+with.  Only the rows within datetime_range (see make_datetime_range) are
+read.  See csv_utilities.read_rows for columns."""
+    path, source = location
+    with closing(connect(path)) as connection:
+        separator, width, stored_index = get_source(connection, source,
+                                                    "transactions")
+        if width and date_index % width != stored_index:
+            raise ValueError("Source is sorted on field %i" % stored_index,
+                             source, date_index)
+        condition, parameters = key_range(datetime_range)
+        cursor = connection.execute("SELECT key, row FROM transactions "
+                                    "WHERE source = ?" + condition +
+                                    " ORDER BY key, line",
+                                    (source,) + parameters)
+        pick = column_picker(columns) if columns is not None else None
+        loads = json.loads
+        for key, text in cursor:
+            row = loads(text)
+            row[stored_index] = key_to_datetime(key)
+            yield pick(row) if pick else row
+
+def row_width(location):
+    """Returns the number of columns in the rows of a source."""
+    with closing(connect(location[0])) as connection:
+        return get_source(connection, location[1], "transactions")[1]
+
+def get_sorted_lines_store(location, sort_field=0, keep_datetime_objects=False,
+                           columns=None, datetime_range=None):
+    """Like csv_utilities.get_sorted_lines, for a source in a store (see
+read_dated_rows)."""
+    with closing(connect(location[0])) as connection:
+        separator = get_source(connection, location[1], "transactions")[0]
+    with profiling.stage("store query"):
+        rows = list(read_dated_rows(location, sort_field, columns, datetime_range))
+    profiling.count("rows", len(rows))
+    if not keep_datetime_objects:
+        field = column_position(columns, sort_field)
+        for row in rows:
+            row[field] = str(row[field])
+    return rows, separator
+
+def read_rate_table(location, max_gap=MAX_GAP, scale=None):
+    """Returns a RateTable of the rates saved under a source, rounded to
+scale if given (see fixed_point.py)."""
+    path, source = location
+    rates = RateTable(max_gap=max_gap)
+    parse = Decimal if scale is None else fixed_point.make_decimal_parser(scale)
+    with closing(connect(path)) as connection:
+        get_source(connection, source, "rates")
+        with profiling.stage("store query"):
+            for ordinal, rate in connection.execute(
+                    "SELECT ordinal, rate FROM rates WHERE source = ? "
+                    "ORDER BY ordinal", (source,)):
+                rates.append_ordinal(ordinal, parse(rate))
+    return rates
+
+def lookup_rate(location, date, max_gap=MAX_GAP):
+    """Returns the rate saved under a source for a date, or the closest
+prior date no more than max_gap days earlier, as RateTable.lookup."""
+    path, source = location
+    ordinal = date.toordinal()
+    with closing(connect(path)) as connection:
+        get_source(connection, source, "rates")
+        found = connection.execute("SELECT ordinal, rate FROM rates "
+                                   "WHERE source = ? AND ordinal <= ? "
+                                   "ORDER BY ordinal DESC LIMIT 1",
+                                   (source, ordinal)).fetchone()
+    if found is None or ordinal - found[0] > max_gap:
+        raise ValueError("Invalid rates/date", date, max_gap)
+    return Decimal(found[1])
+
+def list_sources(path):
+    with closing(connect(path)) as connection:
+        return connection.execute(
+            "SELECT name, kind, filename, "
+            "(SELECT count(*) FROM transactions WHERE source = name) + "
+            "(SELECT count(*) FROM rates WHERE source = name) "
+            "FROM sources ORDER BY name").fetchall()
+
+def print_syntax_info():
+    print("Error, use:", sys.argv[0], "<database> import <source> <CSV file> [date_index]")
+    print("      ", sys.argv[0], "<database> import-rates <source> <CSV file> <low,high> [date_index]")
+    print("      ", sys.argv[0], "<database> list")
+    print()
+    print("Then read a source with sqlite:<database>#<source> in place of a file,")
+    print("for example ./summarize.py sqlite:taxes.db#wallet1 0 1")
+
+def runner():
+    profiling.enable_from_arguments()
+    dialect_filename = get_option("--dialect")
+    try:
+        path, command = sys.argv[1:3]
+        source = sys.argv[3] if command != "list" else None
+        arguments = sys.argv[4:]
+        if command == "import":
+            filename = arguments[0]
+            date_index = int(arguments[1]) if len(arguments) > 1 else 0
+        elif command == "import-rates":
+            filename = arguments[0]
+            low, _, high = arguments[1].partition(",")
+            low, high = int(low), int(high or low)
+            date_index = int(arguments[2]) if len(arguments) > 2 else 0
+        elif command != "list":
+            raise ValueError(command)
+    except (IndexError, ValueError):
+        print_syntax_info()
+        sys.exit(1)
+    if command == "list":
+        for name, kind, filename, count in list_sources(path):
+            print(name, kind, count, filename)
+        return
+    if command == "import":
+        profile = dialect.get(dialect_filename, filename, date_index)
+        count = import_transactions(path, source, filename, date_index,
+                                    dialect=profile)
+        print("Imported", count, "rows as", STORE_PREFIX + path + "#" + source)
+    else:
+        count = import_rates(path, source, filename, low, high, date_index)
+        print("Imported", count, "rates as", STORE_PREFIX + path + "#" + source)
+
+if __name__ == "__main__":
+    runner()
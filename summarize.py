@@ -1,37 +1,261 @@
 #!/usr/bin/python3
 
-import csv, sys
+import csv, json, sys
 
 from decimal import Decimal
 from collections import OrderedDict
 from datetime import date as Date
 from datetime import timedelta
+from itertools import islice
 
-from csv_utilities import get_sorted_lines, parse_float, is_float, find_absolute_index, filter_on_date_range, ZERO
+from aggregate import Stats
+from csv_utilities import get_sorted_lines, guess_number_format, make_number_parser, parse_float, sample_rows, find_absolute_index, filter_on_date_range, detect_file_format, ZERO, \
+     read_dated_rows, dialect_number_format, is_seekable
 
-from utilities import DEBUG_PRINT
+import cache, checkpoint, dialect, fixed_point, profiling, utilities
+from utilities import DEBUG_PRINT, get_flag, get_option
 
 def parse_transaction_file(filename, date_index=0, field=1, operators="",
-                           start=None, end=None):
+                           start=None, end=None, chunk_size=None, workers=None,
+                           dialect=None, mapped=False, scale=None):
+    """Returns an OrderedDict of datetime -> value, see filter_transactions.
+Only the date and value columns are read, and the date range is applied
+while reading, unless the file can only be read once, like a pipe, when
+the rows are read whole and filtered after parsing, in one process.  See
+csv_utilities.get_sorted_lines for dialect and mapped."""
+    number_format = dialect_number_format(dialect, field)
+    if is_seekable(filename):
+        lines, separator = get_sorted_lines(filename, sort_field=date_index,
+                                            keep_datetime_objects=True,
+                                            expect_quotes=True,
+                                            chunk_size=chunk_size,
+                                            workers=workers,
+                                            columns=[date_index, field],
+                                            date_range=(start, end)
+                                            if start or end else None,
+                                            dialect=dialect, mapped=mapped)
+        date_index, field = 0, 1
+        start = end = None
+    else:
+        lines, separator = get_sorted_lines(filename, sort_field=date_index,
+                                            keep_datetime_objects=True,
+                                            expect_quotes=True,
+                                            chunk_size=chunk_size,
+                                            dialect=dialect)
+    dates, number_format = filter_transactions(
+        lines, date_index=date_index, field=field, operators=operators,
+        start=start, end=end, number_format=number_format, scale=scale)
+    return dates
+
+def filter_transactions(lines, date_index=0, field=1, operators="",
+                        start=None, end=None, number_format=None, scale=None):
+    """Returns an OrderedDict of datetime -> value of the sorted lines that
+are within start and end and match the operators, and the number format
+of the value field, which is guessed from the lines if not given.  With a
+scale, the values are fixed-point ints (see fixed_point.py)."""
     dates = OrderedDict()
-    indexes = []
-    lines, separator = get_sorted_lines(filename, sort_field=date_index,
-                                        keep_datetime_objects=True, expect_quotes=True)
     if start or end:
         lines = filter_on_date_range(start, end, lines,
                                      date_index=date_index)
+    if number_format is None:
+        sample, lines = sample_rows(lines)
+        number_format = guess_number_format([line[field] for line in sample])
+    if scale is not None:
+        parse = fixed_point.make_number_parser(scale, number_format)
+    elif number_format is None:
+        parse = parse_float
+    else:
+        parse = make_number_parser(*number_format)
     for line in lines:
         datetime = line[date_index]
-        value = parse_float(line[field])
+        value = parse(line[field])
         if value < ZERO and not "subtract" in operators:
             continue
         if value > ZERO and not "add" in operators:
             continue
         dates[datetime] = value
-    return dates
+    return dates, number_format
+
+def parse_transactions_incrementally(checkpoint_filename, filename,
+                                     date_index=0, field=1, operators="",
+                                     start=None, end=None, chunk_size=None,
+                                     workers=None, dialect=None, scale=None):
+    """Returns the total and count of the transactions in a file, parsing
+only the rows appended since the checkpoint if possible, and saves a new
+checkpoint."""
+    arguments = (date_index, field, list(operators), start, end)
+    if scale is not None:
+        arguments += ("fixed point", scale)
+    saved = checkpoint.load(checkpoint_filename, filename, arguments)
+    if saved is not None:
+        rows = checkpoint.read_appended_rows(filename, saved, field=date_index)
+        state = saved["state"]
+        if rows is not None and (not rows or state["last"] is None or
+                                 rows[0][date_index] > state["last"]):
+            DEBUG_PRINT("Carrying on from checkpoint with", len(rows), "rows")
+            transactions, number_format = filter_transactions(
+                rows, date_index=date_index, field=field, operators=operators,
+                start=start, end=end, number_format=state["number format"],
+                scale=scale)
+            file_format = saved["format"]
+        else:
+            saved = None
+    if saved is None:
+        state = {"total": ZERO, "count": 0, "last": None, "number format": None}
+        lines, separator = get_sorted_lines(filename, sort_field=date_index,
+                                            keep_datetime_objects=True,
+                                            expect_quotes=True,
+                                            chunk_size=chunk_size,
+                                            workers=workers, dialect=dialect)
+        transactions, number_format = filter_transactions(
+            lines, date_index=date_index, field=field, operators=operators,
+            start=start, end=end,
+            number_format=dialect_number_format(dialect, field), scale=scale)
+        try:
+            file_format = detect_file_format(filename, date_index,
+                                             dialect=dialect)
+        except ValueError:
+            DEBUG_PRINT("Datetime format not settled, no checkpoint saved")
+            file_format = None
+    total, count = sum_transactions(transactions, scale)
+    state["total"] += total
+    state["count"] += count
+    if transactions:
+        state["last"] = next(reversed(transactions))
+    if state["number format"] is None:
+        state["number format"] = number_format
+    if file_format is not None:
+        checkpoint.save(checkpoint_filename, filename, arguments, file_format,
+                        state)
+    return state["total"], state["count"]
+
+def sum_transactions(transactions, scale=None):
+    """Returns the total and count of the transaction values, which are
+fixed-point ints with scale if given, summed exactly as ints."""
+    count = 0
+    total = ZERO if scale is None else 0
+    if utilities.DEBUG:
+        for date, value in transactions.items():
+            DEBUG_PRINT(date, value)
+    with profiling.stage("summing"):
+        for value in transactions.values():
+            total += value
+            count += 1
+    if scale is not None:
+        total = fixed_point.to_decimal(total, scale)
+    return total, count
 
+# Dimensions transactions can be grouped by, called with the row, its
+# datetime and its value.  A column index groups by that column.
+DIMENSIONS = {
+    "year": lambda row, datetime, value: str(datetime.year),
+    "month": lambda row, datetime, value: datetime.strftime("%Y-%m"),
+    "day": lambda row, datetime, value: datetime.date().isoformat(),
+    "sign": lambda row, datetime, value: "subtract" if value < ZERO else "add",
+}
+
+def parse_groupings(text):
+    """Returns a list of groupings from text like year,month,year+sign,3,
+where each grouping is a tuple of dimension names and column indexes."""
+    groupings = []
+    for grouping in text.split(","):
+        dimensions = []
+        for dimension in grouping.split("+"):
+            if dimension not in DIMENSIONS:
+                try:
+                    dimension = int(dimension)
+                except ValueError:
+                    raise ValueError("Unknown dimension", dimension,
+                                     list(DIMENSIONS))
+            dimensions.append(dimension)
+        groupings.append(tuple(dimensions))
+    return groupings
+
+def dimension_function(dimension):
+    if dimension in DIMENSIONS:
+        return DIMENSIONS[dimension]
+    return lambda row, datetime, value: row[dimension]
+
+def group_transactions(filename, groupings, date_index=0, field=1,
+                       operators="", start=None, end=None, dialect=None,
+                       scale=None, chunk_size=None, workers=None, mapped=False):
+    """Returns an OrderedDict of grouping -> dict of key -> Stats (see
+aggregate.py) of the transaction values, for each of groupings, in one
+pass over the file in file order, unless workers, chunk_size or mapped
+are given, when the file is read with them by get_sorted_lines.  With a
+scale, the values are fixed-point ints, kept in fixed_point.Stats."""
+    date_range = (start, end) if start or end else None
+    if (workers or chunk_size or mapped) and is_seekable(filename):
+        rows, separator = get_sorted_lines(filename, sort_field=date_index,
+                                           keep_datetime_objects=True,
+                                           chunk_size=chunk_size,
+                                           workers=workers,
+                                           date_range=date_range,
+                                           dialect=dialect, mapped=mapped)
+    else:
+        rows = read_dated_rows(filename, date_index=date_index,
+                               dialect=dialect, date_range=date_range)
+    number_format = dialect_number_format(dialect, field)
+    if number_format is None:
+        sample, rows = sample_rows(rows)
+        number_format = guess_number_format([row[field] for row in sample])
+    if scale is not None:
+        parse = fixed_point.make_number_parser(scale, number_format)
+        make_stats = lambda: fixed_point.Stats(scale)
+    else:
+        parse = make_number_parser(*number_format) if number_format else parse_float
+        make_stats = Stats
+    groups = OrderedDict((grouping, {}) for grouping in groupings)
+    compiled = [([dimension_function(dimension) for dimension in grouping],
+                 groups[grouping]) for grouping in groups]
+    with profiling.stage("grouping"):
+        for row in rows:
+            datetime = row[date_index]
+            value = parse(row[field])
+            if value < ZERO and not "subtract" in operators:
+                continue
+            if value > ZERO and not "add" in operators:
+                continue
+            for functions, table in compiled:
+                key = tuple(function(row, datetime, value) for function in functions)
+                stats = table.get(key)
+                if stats is None:
+                    stats = table[key] = make_stats()
+                stats.add(value)
+    return groups
+
+def group_rows(groups):
+    """Yields a header and a row per group of group_transactions."""
+    yield ["group", "key", "count", "total", "average"]
+    for grouping, table in groups.items():
+        name = "+".join(map(str, grouping))
+        for key in sorted(table):
+            stats = table[key]
+            yield [name, "+".join(map(str, key)), stats.count, stats.total,
+                   stats.average()]
+
+def print_groups(groups, format_="csv"):
+    if format_ == "json":
+        report = [{"group": group, "key": key, "count": count,
+                   "total": str(total), "average": str(average)}
+                  for group, key, count, total, average in
+                  islice(group_rows(groups), 1, None)]
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    else:
+        csv.writer(sys.stdout, lineterminator="\n").writerows(group_rows(groups))
 
 def runner():
+    profiling.enable_from_arguments()
+    chunk_size = get_option("--sort-chunk-size", type_=int)
+    workers = get_option("--workers", type_=int)
+    checkpoint_filename = get_option("--checkpoint")
+    groupings = get_option("--group-by", type_=parse_groupings)
+    format_ = get_option("--format", "csv")
+    dialect_filename = get_option("--dialect")
+    cache.CACHE_DIR = get_option("--cache-dir", cache.CACHE_DIR)
+    mapped = get_flag("--mmap")
+    scale = get_option("--fixed-point", type_=int)
     try:
         pass
     except IndexError:
@@ -62,16 +286,33 @@ def runner():
         start, end = start_end.split(",")
     except (IndexError, ValueError):
         start = end = None
-    transactions = parse_transaction_file(sys.argv[1], date_index=date_index,
-                                          field=field, operators=operators,
-                                          start=start, end=end)
-    count = 0
-    values = []
-    total = ZERO
-    for date, value in transactions.items():
-        DEBUG_PRINT(date, value)
-        total += value
-        count += 1
+    profile = dialect.get(dialect_filename, sys.argv[1], date_index)
+    if groupings:
+        if checkpoint_filename:
+            print("Error: --checkpoint is not supported with --group-by",
+                  file=sys.stderr)
+            sys.exit(1)
+        groups = group_transactions(sys.argv[1], groupings, date_index=date_index,
+                                    field=field, operators=operators,
+                                    start=start, end=end, dialect=profile,
+                                    scale=scale, chunk_size=chunk_size,
+                                    workers=workers, mapped=mapped)
+        print_groups(groups, format_)
+        return
+    if checkpoint_filename:
+        total, count = parse_transactions_incrementally(
+            checkpoint_filename, sys.argv[1], date_index=date_index,
+            field=field, operators=operators, start=start, end=end,
+            chunk_size=chunk_size, workers=workers, dialect=profile, scale=scale)
+    else:
+        transactions = parse_transaction_file(sys.argv[1], date_index=date_index,
+                                              field=field, operators=operators,
+                                              start=start, end=end,
+                                              chunk_size=chunk_size,
+                                              workers=workers,
+                                              dialect=profile, mapped=mapped,
+                                              scale=scale)
+        total, count = sum_transactions(transactions, scale)
     print()
     print("Total: %f, average %f, entries %i" % (total, total/count, count))
 
@@ -0,0 +1,151 @@
+"""Parsed CSV data stored by column instead of as a list of row lists.
+
+A Table keeps the text of the file as one string, and for each row the
+start and end offset of its line in that string, in arrays.  The sort
+datetime of each row is kept as an int (microseconds since 0001-01-01) in
+an array too, and columns added later, such as converted values, are kept
+as one list per column.  Text columns are only split out of the lines
+when they are asked for.
+
+Iterating over a Table, or indexing it, gives rows like those of
+csv_utilities.get_sorted_lines with keep_datetime_objects=True, so code
+reading rows works with either."""
+
+import io
+
+from array import array
+from itertools import islice
+
+from csv_utilities import guess_separator_file, has_header, split_with_quotes, \
+     guess_datetime_parser, make_datetime_parser, dialect_datetime_format
+import profiling
+from utilities import DEBUG_PRINT, DAY, datetime_to_key, key_to_datetime
+
+class Table:
+    def __init__(self, text, separator, datetime_field, expect_quotes=True):
+        self.text = text
+        self.separator = separator
+        self.datetime_field = datetime_field
+        self.split = split_with_quotes if expect_quotes else str.split
+        self.starts = array("q")
+        self.ends = array("q")
+        self.keys = array("q")
+        self.added = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def line(self, index):
+        return self.text[self.starts[index]:self.ends[index]]
+
+    def __getitem__(self, index):
+        row = self.split(self.line(index), self.separator)
+        row[self.datetime_field] = key_to_datetime(self.keys[index])
+        for column in self.added:
+            row.append(column[index])
+        return row
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def ordinals(self):
+        """Returns an array with the date ordinal of each row."""
+        return array("l", [key // DAY for key in self.keys])
+
+    def datetimes(self):
+        return [key_to_datetime(key) for key in self.keys]
+
+    def column(self, index, count=None):
+        """Returns a list of the values in a column, or of the first count,
+which are split out of the lines unless it is an added column."""
+        width = len(self.split(self.line(0), self.separator)) if len(self) else 0
+        if index < 0:
+            index += width + len(self.added)
+        if index >= width:
+            return self.added[index - width][:count]
+        split = self.split
+        separator = self.separator
+        text = self.text
+        return [split(text[start:end], separator)[index]
+                for start, end in islice(zip(self.starts, self.ends), count)]
+
+    def copy(self):
+        """Returns a Table sharing the text and rows of this one, without
+its added columns, for converting the same rows more than one way."""
+        table = Table(self.text, self.separator, self.datetime_field)
+        table.split = self.split
+        table.starts = self.starts
+        table.ends = self.ends
+        table.keys = self.keys
+        return table
+
+    def add_column(self, values):
+        """Adds a column, such as converted values, after the existing ones."""
+        if len(values) != len(self):
+            raise ValueError("Column length doesn't match", len(values), len(self))
+        self.added.append(values)
+
+def get_sorted_table(filename, sort_field=0, expect_quotes=True, dialect=None):
+    """Returns a Table of a CSV file sorted on the datetime in sort_field,
+and the separator.  See csv_utilities.get_sorted_lines for dialect."""
+    with open(filename, "r") as file:
+        if not file.seekable():
+            # A pipe is read once, so separators are counted in its text
+            file = io.StringIO(file.read())
+        if dialect:
+            separator = dialect["separator"]
+            expect_quotes = dialect["quoting"]
+        else:
+            with profiling.stage("separator detection"):
+                separator = guess_separator_file(file)
+        text = file.read()
+    profiling.count("bytes", len(text))
+    table = Table(text, separator, sort_field, expect_quotes=expect_quotes)
+    split = table.split
+    with profiling.stage("splitting"):
+        lines = text.split("\n")
+        if lines and not lines[-1]:
+            lines.pop()
+        if dialect:
+            header = dialect["header"]
+        else:
+            header = has_header([line.rstrip() for line in lines[:3]])
+        DEBUG_PRINT("Has header", header)
+        starts = []
+        ends = []
+        dates = []
+        start = 0
+        for line in lines:
+            stripped = line.rstrip()
+            starts.append(start)
+            ends.append(start + len(stripped))
+            dates.append(split(stripped, separator)[sort_field])
+            start += len(line) + 1
+        del lines
+        if header and starts:
+            del starts[0], ends[0], dates[0]
+    profiling.count("rows", len(dates))
+    if not dates:
+        return table, separator
+    datetime_format = dialect_datetime_format(dialect, sort_field)
+    with profiling.stage("date detection"):
+        if datetime_format:
+            parse, strptime_format = make_datetime_parser(*datetime_format)
+        else:
+            parse, strptime_format = guess_datetime_parser(dates)
+    DEBUG_PRINT("strptime_format", strptime_format)
+    with profiling.stage("date parsing"):
+        keys = {}
+        for index, value in enumerate(dates):
+            key = keys.get(value)
+            if key is None:
+                key = keys[value] = datetime_to_key(parse(value))
+            dates[index] = key
+        del keys
+    with profiling.stage("sorting"):
+        order = sorted(range(len(dates)), key=dates.__getitem__)
+        table.starts = array("q", [starts[index] for index in order])
+        table.ends = array("q", [ends[index] for index in order])
+        table.keys = array("q", [dates[index] for index in order])
+    return table, separator
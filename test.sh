@@ -4,3 +4,242 @@
 ./mda.py testdata/USD-NOK.csv -2 2023-01-01,2023-12-31
 ./mda.py testdata/EUR-NOK.csv -2 2023-01-01,2023-12-31
 ./summarize.py testdata/EUR-NOK.csv 14 15
+
+# Checks, each printing ok or FAILED; exits with 1 if any failed
+
+failed=0
+tmp=$(mktemp -d)
+trap 'rm -rf "$tmp"' EXIT
+
+check() {
+    local name=$1
+    shift
+    if "$@" > /dev/null 2>&1; then
+        echo "ok     $name"
+    else
+        echo "FAILED $name"
+        failed=1
+    fi
+}
+
+# True if two commands, given as strings, write the same output
+same() {
+    cmp -s <(eval "$1" 2>&1) <(eval "$2" 2>&1)
+}
+
+# True if a command fails and its output has the given text
+fails_with() {
+    local output
+    output=$(eval "$1" 2>&1) && return 1
+    grep -qF -- "$2" <<< "$output"
+}
+
+tx=testdata/transactions.csv
+eur="testdata/EUR-USD.csv 1,2"
+nok="testdata/USD-NOK.csv -1 -2"
+
+# Pipes, which can only be read once
+check "rates from a pipe" \
+    same "./rates.py <(cat testdata/USD-NOK.csv) -1,-1 -2" \
+         "./rates.py testdata/USD-NOK.csv -1,-1 -2"
+check "process_chain from pipes" \
+    same "./process_chain.py <(cat $tx) 0,1 :: <(cat testdata/EUR-USD.csv) 1,2 :: <(cat testdata/USD-NOK.csv) -1 -2" \
+         "./process_chain.py $tx 0,1 :: $eur :: $nok"
+
+# Composed rates
+check "compose is hop by hop without the middle value" \
+    same "./process_chain.py $tx 0,1 :: $eur :: $nok --compose" \
+         "./process_chain.py $tx 0,1 :: $eur :: $nok | cut -d, -f1-5,7"
+
+# Statistics
+check "mda without rows in the range" \
+    bash -c "./mda.py testdata/USD-NOK.csv -2 2030-01-13,2030-02-20 | grep -q 'No rows'"
+
+# Workers
+check "mda with workers and sort chunks" \
+    same "./mda.py testdata/USD-NOK.csv -2 2016-01-13,2022-12-20 --windows year --workers 2 --sort-chunk-size 300" \
+         "./mda.py testdata/USD-NOK.csv -2 2016-01-13,2022-12-20 --windows year"
+check "workers and sort chunks convert the same" \
+    same "./process_chain.py $tx 0,1 :: $eur :: $nok --workers 2 --sort-chunk-size 100" \
+         "./process_chain.py $tx 0,1 :: $eur :: $nok"
+
+# Memory mapped input
+check "mmap converts the same" \
+    same "./process_chain.py $tx 0,1 :: $eur :: $nok --mmap" \
+         "./process_chain.py $tx 0,1 :: $eur :: $nok"
+
+# A store gives what the CSV files give
+db=$tmp/store.db
+./store.py $db import tx $tx 0 > /dev/null
+./store.py $db import usdnok testdata/USD-NOK.csv -2 > /dev/null
+./store.py $db import-rates eur testdata/EUR-USD.csv 1,2 0 > /dev/null
+./store.py $db import-rates nok testdata/USD-NOK.csv -1,-1 -2 > /dev/null
+check "store summarize" \
+    same "./summarize.py sqlite:$db#tx 0 1 2016-01-01,2017-12-31" \
+         "./summarize.py $tx 0 1 2016-01-01,2017-12-31"
+check "store mda" \
+    same "./mda.py sqlite:$db#usdnok -2 2023-01-01,2023-12-31" \
+         "./mda.py testdata/USD-NOK.csv -2 2023-01-01,2023-12-31"
+check "store process_chain" \
+    same "./process_chain.py sqlite:$db#tx 0,1 :: sqlite:$db#eur 1,2 :: sqlite:$db#nok -1 -2" \
+         "./process_chain.py $tx 0,1 :: $eur :: $nok"
+
+check "store process_chain --fixed-point" \
+    same "./process_chain.py sqlite:$db#tx 0,1 :: sqlite:$db#eur 1,2 :: sqlite:$db#nok -1 -2 --fixed-point 4,8,2" \
+         "./process_chain.py $tx 0,1 :: $eur :: $nok --fixed-point 4,8,2"
+
+# A value in another number format than the sample's
+{ echo "Date,Amount"; for day in $(seq 10 28); do echo "2023-01-$day,1.5"; done; } > $tmp/numbers.csv
+cp $tmp/numbers.csv $tmp/mixed.csv
+echo '2023-02-01,"2,5"' >> $tmp/mixed.csv
+echo '2023-02-01,2.5' >> $tmp/numbers.csv
+check "summarize mixed number formats" \
+    same "./summarize.py $tmp/mixed.csv 0 1" "./summarize.py $tmp/numbers.csv 0 1"
+
+# Dialect profiles
+check "dialect profile converts the same" \
+    same "./summarize.py $tx 0 1 --dialect $tmp/transactions.json" "./summarize.py $tx 0 1"
+check "dialect looks for quotes in the sample only" python3 -c "
+import dialect
+with open('$tmp/late-quotes.csv', 'w') as file:
+    file.write('Date,Amount\\n' + '2023-01-13,1\\n' * 500 + '\"2023-01-14\",1\\n')
+assert dialect.has_quotes('$tx') and not dialect.has_quotes('$tmp/late-quotes.csv')"
+
+# Groups
+check "summarize grouped by the date column" ./summarize.py $tx 0 1 --group-by 0
+check "groups with workers, sort chunks and mmap" \
+    same "./summarize.py $tx 0 1 --group-by month,year --workers 2 --sort-chunk-size 30 --mmap" \
+         "./summarize.py $tx 0 1 --group-by month,year"
+check "groups refuse --checkpoint" \
+    fails_with "./summarize.py $tx 0 1 --group-by year --checkpoint $tmp/groups.checkpoint" \
+               "not supported with --group-by"
+
+# Columns
+check "mda negative date index with --columns" \
+    same "./mda.py testdata/USD-NOK.csv -2 2023-01-01,2023-12-31 --columns 14,15" \
+         "./mda.py testdata/USD-NOK.csv 14 2023-01-01,2023-12-31 --columns 14,15"
+check "summarize from a pipe" \
+    same "./summarize.py <(cat testdata/USD-NOK.csv) 14 15 2016-01-13,2017-01-20" \
+         "./summarize.py testdata/USD-NOK.csv 14 15 2016-01-13,2017-01-20"
+check "mda from a pipe with --columns" \
+    same "./mda.py <(cat testdata/USD-NOK.csv) -2 2023-01-01,2023-12-31 --columns 14,15" \
+         "./mda.py testdata/USD-NOK.csv -2 2023-01-01,2023-12-31 --columns 14,15"
+
+# The first dates read either way, 2023-01-01 to 2023-10-10
+{ echo "Date,Amount"
+  for month in 01 02 03 04 05 06 07 08 09 10; do echo "2023-$month-$month,1"; done
+  for day in $(seq 13 28); do for month in 01 05 09 12; do echo "2023-$month-$day,2"; done; done
+} > $tmp/ambiguous.csv
+check "sort chunks guess dates from a sample" \
+    same "./summarize.py $tmp/ambiguous.csv 0 1 --sort-chunk-size 10" \
+         "./summarize.py $tmp/ambiguous.csv 0 1"
+
+# Batch manifests
+echo "$tx 0,1 :: $eur > $tmp/a.csv" > $tmp/manifest.txt
+cp $tmp/manifest.txt $tmp/duplicate.txt
+echo "$tx 0,1 :: $nok > $tmp/a.csv" >> $tmp/duplicate.txt
+check "batch rejects an output written twice" \
+    fails_with "./batch.py $tmp/duplicate.txt" "line 2: Output file also written by line 1"
+cp $tmp/manifest.txt $tmp/unclosed.txt
+echo "\"$tx 0,1" >> $tmp/unclosed.txt
+check "batch reports the line of an unclosed quote" \
+    fails_with "./batch.py $tmp/unclosed.txt" "line 2: No closing quotation"
+cp $tmp/manifest.txt $tmp/missing.txt
+echo "$tx 0,1 :: $tmp/missing.csv 1,2 > $tmp/b.csv" >> $tmp/missing.txt
+rm -f $tmp/a.csv
+check "batch reports a failed chain" \
+    fails_with "./batch.py $tmp/missing.txt" "Error in chain on line 2"
+check "batch runs the other chains" test -s $tmp/a.csv
+cp $tmp/manifest.txt $tmp/columns.txt
+echo "$tx 0,9 :: $eur > $tmp/b.csv" >> $tmp/columns.txt
+echo "$tx 0,1 :: testdata/EUR-USD.csv 1,9 > $tmp/c.csv" >> $tmp/columns.txt
+echo "$tx 0,1 :: $nok > $tmp/d.csv" >> $tmp/columns.txt
+rm -f $tmp/a.csv
+check "batch reports a column out of range" \
+    fails_with "./batch.py $tmp/columns.txt" "Error in chain on line 3"
+check "batch runs the chains around it" test -s $tmp/a.csv -a -s $tmp/d.csv
+
+# Binary column files
+check "binary rejects rows of another width" python3 -c "
+import binary, os, sys
+from decimal import Decimal
+try:
+    binary.write(sys.argv[1], [[Decimal(1), 'a'], [Decimal(2)]])
+except ValueError:
+    sys.exit(os.path.exists(sys.argv[1]))
+sys.exit(1)" $tmp/ragged.bin
+check "a pipe isn't read to look for a binary file" \
+    same "./csv_utilities.py <(cat $tx)" "./csv_utilities.py $tx"
+
+# Lots
+check "match_lots parses both number formats by default" python3 -c "
+from decimal import Decimal
+from lots import match_lots
+rows = [['2023-01-01', '2,0', '10'], ['2023-02-01', '-1.0', '7,5']]
+assert list(match_lots(rows, 0, 1, 2)) == \
+       [('2023-02-01', '', Decimal(1), Decimal('7.5'), Decimal(5), Decimal('2.5'))]"
+printf "Date,Amount,Value\n2023-01-13,2,10\n2023-02-14,-5,20\n" > $tmp/oversold.csv
+check "lots reports disposing of more than held" \
+    fails_with "./lots.py $tmp/oversold.csv 0,1,2" "Error: Disposing of more than held"
+check "lots rejects an unknown method" \
+    fails_with "./lots.py $tmp/oversold.csv 0,1,2 --method fofi" "Error: unknown method"
+
+# Server
+echo keep > $tmp/not-a-socket
+check "server leaves a file at --socket alone" \
+    bash -c "! ./server.py --socket $tmp/not-a-socket && grep -q keep $tmp/not-a-socket"
+check "server refuses files outside its root" python3 -c "
+import server
+tables = server.RateTables(root='testdata')
+tables.resolve('USD-NOK.csv')
+try:
+    tables.resolve('../rates.py')
+except PermissionError:
+    pass
+else:
+    raise AssertionError('Served ../rates.py')"
+
+# Benchmark
+check "benchmark --compare needs two files" \
+    fails_with "./benchmark.py --compare $tmp/old.json" "Error, use:"
+check "benchmark times the pipeline stages" \
+    bash -c "./benchmark.py --rows 200 --output $tmp/benchmark.json --directory $tmp && grep -q conversion $tmp/benchmark.json"
+
+# Fixed-point rounding
+check "fixed-point parsing rounds half to even" python3 -c "
+import fixed_point
+parse = fixed_point.make_parser(2)
+assert [parse(value) for value in ['0.125', '0.135', '-0.125', '-0.135', '1e3', '1,5']] == \
+       [12, 14, -12, -14, 100000, 150]"
+check "fixed-point midpoint rounds half to even" python3 -c "
+from decimal import Decimal
+from fixed_point import midpoint
+pairs = [('0.01', '0.02'), ('0.02', '0.03'), ('-0.01', '-0.02'), ('-0.02', '-0.03')]
+assert [str(midpoint(Decimal(low), Decimal(high), 2)) for low, high in pairs] == \
+       ['0.02', '0.02', '-0.02', '-0.02']"
+check "fixed-point chains round each conversion" python3 -c "
+from decimal import Decimal
+from fixed_point import Chain
+from rates import RateTable
+rates = RateTable()
+rates.append_ordinal(1, Decimal('1.5000000000'))
+chain = Chain([2, 0], 1)
+parse = chain.parser()
+values = [parse(value) for value in ['0.125', '-0.125', '0.33', '1.50', '-0.01']]
+amounts, converted = chain.convert([rates], [1] * len(values), values)
+assert list(map(str, amounts)) == ['0.12', '-0.12', '0.33', '1.50', '-0.01'], amounts
+assert list(map(str, converted)) == ['0', '0', '0', '2', '0'], converted"
+check "fixed-point conversion is the int rounding" python3 -c "
+from decimal import Decimal
+from fixed_point import Chain, round_shift, to_decimal
+from rates import RateTable
+rates = RateTable()
+rates.append_ordinal(1, to_decimal(123456789, 10))
+chain = Chain([4, 3], 1)
+values = list(range(-5000, 5000, 7))
+converted = chain.convert([rates], [1] * len(values), [to_decimal(v, 4) for v in values])[1]
+assert converted == [to_decimal(round_shift(v * 123456789, 11), 3) for v in values]"
+check "fixed-point statistics print plain" \
+    bash -c "! ./mda.py testdata/USD-NOK.csv -2 2023-01-01,2023-12-31 --fixed-point 8 --windows year | grep -q E-"
+
+exit $failed
@@ -1,5 +1,11 @@
+import sys
+
+from datetime import datetime, timedelta
+
 DEBUG = False
 WARNING = False
+DAY = 86400 * 1000000
+STORE_PREFIX = "sqlite:"
 
 def DEBUG_PRINT(*arguments):
     if DEBUG:
@@ -8,3 +14,52 @@ def DEBUG_PRINT(*arguments):
 def WARNING_PRINT(*arguments):
     if WARNING:
         print(*arguments, file=sys.stderr)
+
+def get_option(name, default=None, type_=str, arguments=None):
+    """Removes an option and its value, for example --workers 4, from the
+command line arguments, and returns the value converted with type_.
+
+Returns default if the option isn't given."""
+    if arguments is None:
+        arguments = sys.argv
+    try:
+        index = arguments.index(name)
+    except ValueError:
+        return default
+    try:
+        value = arguments[index + 1]
+    except IndexError:
+        print("Error, %s needs a value" % name)
+        sys.exit(1)
+    del arguments[index:index + 2]
+    return type_(value)
+
+def get_flag(name, arguments=None):
+    """Removes a flag, for example --mmap, from the command line arguments,
+and returns whether it was given."""
+    if arguments is None:
+        arguments = sys.argv
+    if name not in arguments:
+        return False
+    arguments.remove(name)
+    return True
+
+def store_location(filename):
+    """Returns the database path and source name of a filename of the form
+sqlite:PATH#SOURCE (see store.py), or None for other filenames."""
+    if not filename.startswith(STORE_PREFIX):
+        return None
+    path, separator, source = filename[len(STORE_PREFIX):].rpartition("#")
+    if not separator or not path or not source:
+        raise ValueError("Use sqlite:PATH#SOURCE", filename)
+    return path, source
+
+def datetime_to_key(value):
+    """Returns a datetime as microseconds since 0001-01-01, for keeping
+datetimes in arrays."""
+    return ((value.toordinal() * 86400 + value.hour * 3600 + value.minute * 60
+             + value.second) * 1000000 + value.microsecond)
+
+def key_to_datetime(key):
+    days, microseconds = divmod(key, DAY)
+    return datetime.fromordinal(days) + timedelta(microseconds=microseconds)